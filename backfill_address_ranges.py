@@ -0,0 +1,43 @@
+"""
+Set the ranges of the Address documents written before the ranges were
+kept, /addresses/lookup does not find the addresses without them. Run once
+after upgrading:
+
+    python backfill_address_ranges.py
+"""
+import os
+
+from mongoengine import Q, connect
+from mongoengine.errors import ValidationError
+
+import base_query
+import ip_ranges
+import models
+
+DB_HOST = os.getenv('MONGODB_HOST', 'mongodb://localhost/sbf')
+
+
+def backfill():
+    updated = 0
+    missing = Q(ranges__exists=False) | Q(ranges__size=0)
+    for doc in models.Address.objects(missing).only('name', 'value').as_pymongo():
+        data = {'value': doc.get('value', '')}
+        try:
+            ip_ranges.prepare_address(data)
+        except ValidationError as e:
+            print("%s: %s" % (doc.get('name'), e))
+            continue
+        models.Address.objects(id=doc['_id']).update_one(set__ranges=data['ranges'])
+        updated += 1
+    if updated:
+        base_query.bump_version(models.Address)
+    return updated
+
+
+def main():
+    connect(host=DB_HOST)
+    print("%d addresses updated" % backfill())
+
+
+if __name__ == "__main__":
+    main()
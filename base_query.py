@@ -1,50 +1,302 @@
+import base64
+import calendar
 import datetime
-import json
+import os
+import re
+import time
 
+from bson import json_util, ObjectId
+from bson.errors import BSONError
+from mongoengine.base import get_document
+from mongoengine.errors import FieldDoesNotExist, InvalidQueryError, LookUpError, ValidationError
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
-def make_search_string(exclude_keys=None, **kwargs):
-    if exclude_keys is None:
-        exclude_keys = []
-    valid_keys = set(kwargs.keys()) - set(exclude_keys)
-    values = [str(kwargs[val]) for val in valid_keys]
-    return " ".join(values)
 
-def get_all_items(model_cls_name, page_size=25, page=1, sort=None, **kwargs):
+class QueryError(ValueError):
+    """
+    Invalid query arguments (eg. a malformed cursor) or bulk items, a 400
+    in the api
+    """
+
+
+# seconds a collection version read from db is used before reading it again
+VERSION_TTL = float(os.getenv('SBF_VERSION_TTL', 1))
+VERSIONS_COLLECTION = 'collection_versions'
+
+# collection name -> (version, time read)
+_versions = {}
+
+
+def bump_version(model_cls_name):
+    """
+    Increment the version of the model's collection, called on every write
+    so that the cached responses of the collection are not used anymore
+    """
+    name = model_cls_name._get_collection_name()
+    rsp = model_cls_name._get_db()[VERSIONS_COLLECTION].find_one_and_update(
+        {'_id': name}, {'$inc': {'version': 1}}, upsert=True,
+        return_document=ReturnDocument.AFTER)
+    _versions[name] = (rsp['version'], time.time())
+    return rsp['version']
+
+
+def get_version(model_cls_name):
+    """
+    Version of the model's collection. The version is read from db at most
+    every VERSION_TTL seconds, the writes from this process update it
+    right away
+    """
+    name = model_cls_name._get_collection_name()
+    version, read_time = _versions.get(name, (None, 0))
+    if time.time() - read_time < VERSION_TTL:
+        return version
+    doc = model_cls_name._get_db()[VERSIONS_COLLECTION].find_one({'_id': name})
+    version = doc['version'] if doc else 0
+    _versions[name] = (version, time.time())
+    return version
+
+
+def tokenize(value):
+    """
+    Lower case tokens of the value, nested dicts/lists are flattened. A
+    value gives the whole value and its alphanumeric parts as tokens, so
+    10.1.2.3 can be searched as 10.1 or 2 and proxy-web as web
+    """
+    tokens = set()
+    if value is None:
+        return tokens
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        for val in value:
+            tokens.update(tokenize(val))
+        return tokens
+    text = str(value).lower()
+    tokens.update(text.split())
+    tokens.update(re.split(r'[^0-9a-z]+', text))
+    tokens.discard('')
+    return tokens
+
+
+def search_tokens(model_cls_name, data, exclude_search=None):
+    """
+    Tokens of the model's search_fields values in data
+    """
+    if exclude_search is None:
+        exclude_search = []
+    tokens = set()
+    for field in model_cls_name.search_fields:
+        if field not in exclude_search:
+            tokens.update(tokenize(data.get(field)))
+    return sorted(tokens)
+
+
+def search_query(search):
+    """
+    Raw query to find the documents having all the words in search as a
+    token prefix. The anchored regexes use the search_tokens index
+    """
+    words = search.lower().split()
+    return {'search_tokens': {'$all': [re.compile('^' + re.escape(word)) for word in words]}}
+
+
+def rebuild_search_tokens(model_cls_name, missing_only=True, batch_size=500):
+    """
+    Compute search_tokens of the documents written before search_tokens
+    (all the documents unless missing_only), return the number of
+    documents updated
+    """
+    rsp = model_cls_name.objects
+    if missing_only:
+        rsp = rsp(search_tokens__exists=False)
+    ops = []
+    updated = 0
+    for doc in rsp.as_pymongo().batch_size(batch_size):
+        ops.append(UpdateOne({'_id': doc['_id']},
+                             {'$set': {'search_tokens': search_tokens(model_cls_name, doc)}}))
+        if len(ops) >= batch_size:
+            model_cls_name._get_collection().bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        model_cls_name._get_collection().bulk_write(ops, ordered=False)
+        updated += len(ops)
+    if updated:
+        bump_version(model_cls_name)
+    return updated
+
+
+def to_json_value(value):
+    """
+    Convert a raw mongo value to what json.loads(to_json()) returned so far
+    (object ids as string, dates as epoch milliseconds)
+    """
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, dict):
+        return {key: to_json_value(val) for key, val in value.items()}
+    if isinstance(value, list):
+        return [to_json_value(val) for val in value]
+    return value
+
+
+def to_dict(doc):
+    """
+    Build the response dict directly from a raw (as_pymongo) document
+    """
+    item = {key: to_json_value(value) for key, value in doc.items() if key != '_id'}
+    item['id'] = str(doc['_id'])
+    return item
+
+
+def project(model_cls_name, rsp, fields=None, exclude=None):
+    """
+    Apply the projection on the queryset so that only the needed fields are
+    read from mongo. fields is a comma separated list of the fields to return.
+    exclude defaults to the model's exclude_fields, these are never returned
+    even if asked for in fields. fields with no valid field is ignored
+    """
+    if exclude is None:
+        exclude = getattr(model_cls_name, 'exclude_fields', [])
+    exclude = list(exclude) + ['search_tokens']
+    if fields:
+        fields = [field.strip() for field in fields.split(',')]
+        fields = [field for field in fields
+                  if field in model_cls_name._fields and field not in exclude]
+        if fields:
+            return rsp.only(*fields).as_pymongo()
+        # none of the fields can be returned, only() with no fields would
+        # return all of them, the excluded ones too
+    if exclude:
+        rsp = rsp.exclude(*exclude)
+    return rsp.as_pymongo()
+
+
+def request_exclude(model_cls_name, exclude=None):
+    """
+    Fields to leave out for the exclude argument of a request, a comma
+    separated list of fields added to the model's exclude_fields (a request
+    can not get the excluded fields back)
+    """
+    fields = list(getattr(model_cls_name, 'exclude_fields', []))
+    if exclude:
+        fields.extend(field.strip() for field in exclude.split(',') if field.strip())
+    return fields
+
+
+def encode_cursor(doc, sort_field=None):
+    """
+    Build the opaque keyset cursor for the raw doc. The cursor carries the
+    value of the sort field (if any) and the document id so the next page
+    can resume right after this document
+    """
+    value = {'id': doc['_id']}
+    if sort_field:
+        value['v'] = doc.get(sort_field)
+    return base64.urlsafe_b64encode(json_util.dumps(value).encode()).decode()
+
+
+def decode_cursor(cursor, sort_field=None):
+    """
+    Value of the cursor, QueryError if it is not a cursor of encode_cursor
+    """
+    try:
+        value = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError, BSONError):
+        raise QueryError("invalid cursor")
+    if (not isinstance(value, dict) or not isinstance(value.get('id'), ObjectId)
+            or (sort_field and 'v' not in value)):
+        raise QueryError("invalid cursor")
+    return value
+
+
+def cursor_query(cursor, sort_field=None, descending=False):
+    """
+    Raw mongo query that selects the documents after the cursor in the
+    (sort_field, _id) order. The documents with a null or missing sort
+    field come first in the ascending order, last in the descending one,
+    they are not matched by $gt/$lt
+    """
+    value = decode_cursor(cursor, sort_field)
+    op = '$lt' if descending else '$gt'
+    if not sort_field:
+        return {'_id': {op: value['id']}}
+    same_value = {sort_field: value['v'], '_id': {op: value['id']}}
+    if value['v'] is None:
+        if descending:
+            return same_value
+        return {'$or': [same_value, {sort_field: {'$ne': None}}]}
+    after = [{sort_field: {op: value['v']}}, same_value]
+    if descending:
+        after.append({sort_field: None})
+    return {'$or': after}
+
+
+def count_items(model_cls_name, rsp, mode, filtered=False):
+    """
+    mode is one of exact, estimated or none. estimated reads the collection
+    metadata and is only used when there is no filter on the query
+    """
+    if mode == 'none':
+        return None
+    if mode == 'estimated' and not filtered:
+        return model_cls_name._get_collection().estimated_document_count()
+    return rsp.count()
+
+
+def get_all_items(model_cls_name, page_size=25, page=1, sort=None, after=None,
+                  count=None, fields=None, exclude=None, **kwargs):
     """
     Get a list of documents from the model_cls_name (models.<ClassName>).
     The query is provided as key-value pairs in kwargs.
     sort : sort field name (-name to sort in descending)
     page_size: number of documents to return
     page: page number
+    after: cursor (next_cursor of the previous response) to page with a
+        keyset on (sort, _id) instead of skip/limit. Pass an empty string
+        to get the first page in cursor mode
+    count: exact, estimated or none. Defaults to exact in page mode and
+        none in cursor mode
+    fields: comma separated field names to return (all except the model's
+        exclude_fields by default)
+    exclude: comma separated field names to leave out, in addition to the
+        model's exclude_fields
     """
+    exclude = request_exclude(model_cls_name, exclude)
+    filtered = bool(kwargs)
     if 'search' in kwargs:
         search = kwargs.pop('search')
-        rsp = model_cls_name.objects(**kwargs).search_text(search)
+        rsp = model_cls_name.objects(**kwargs).filter(__raw__=search_query(search))
     else:
         rsp = model_cls_name.objects(**kwargs)
+    try:
+        page_size = int(page_size)
+        page = int(page)
+    except ValueError:
+        raise QueryError("page and page_size must be integers")
+    if after is not None:
+        return get_items_after(model_cls_name, rsp, page_size, sort, after,
+                               count or 'none', filtered, fields, exclude)
     if sort:
         rsp = rsp.order_by(sort)
-    page_size = int(page_size)
-    page = int(page)
     start = (page - 1) * page_size
     end = start + page_size
+    docs = project(model_cls_name, rsp, fields, exclude)
     if end > 0:
-        docs = json.loads(rsp[start:end].to_json())
-    else:
-        docs = json.loads(rsp.to_json())
-    for doc in docs:
-        doc['id'] = doc['_id']['$oid']
-        doc.pop('_id', None)
-        doc['date_added'] = doc['date_added']['$date']
-        doc['date_modified'] = doc['date_modified']['$date']
+        docs = docs[start:end]
+    docs = [to_dict(doc) for doc in docs]
+    total = count_items(model_cls_name, rsp, count or 'exact', filtered)
     next_page = page + 1
-    if (next_page - 1) * page_size >= rsp.count():
+    if total is not None and (next_page - 1) * page_size >= total:
         next_page = -1
     prev_page = page - 1
     if prev_page < 0:
         prev_page = -1
     body = {
-        'count': rsp.count(),
+        'count': total,
         'page': page,
         'page_size': page_size,
         'next_page': next_page,
@@ -56,29 +308,282 @@ def get_all_items(model_cls_name, page_size=25, page=1, sort=None, **kwargs):
     return body
 
 
-def get_item(model_cls_name, **kwargs):
+def get_items_after(model_cls_name, rsp, page_size, sort, after, count, filtered,
+                    fields=None, exclude=None):
+    """
+    Cursor mode of get_all_items. The cost of a page does not depend on how
+    deep the client has paged as there is no skip, mongo seeks on the
+    (sort, _id) index position given by the cursor
+    """
+    sort_field = None
+    descending = False
+    if sort:
+        descending = sort.startswith('-')
+        sort_field = sort.lstrip('-+')
+        if exclude is None:
+            exclude = getattr(model_cls_name, 'exclude_fields', [])
+        if sort_field == 'id':
+            # the _id order
+            sort_field = None
+        elif sort_field not in model_cls_name._fields or sort_field in exclude:
+            # the value of the sort field is in the cursor
+            raise QueryError("cannot page on the sort field %s" % sort_field)
+    if page_size < 1:
+        raise QueryError("page_size must be at least 1")
+    total = count_items(model_cls_name, rsp, count, filtered)
+    id_order = '-id' if descending else 'id'
+    if sort_field:
+        rsp = rsp.order_by(sort, id_order)
+    else:
+        rsp = rsp.order_by(id_order)
+    if after:
+        rsp = rsp.filter(__raw__=cursor_query(after, sort_field, descending))
+    if sort_field and fields:
+        # the sort field is needed in the doc to build the cursor
+        fields = fields + ',' + sort_field
+    # get one extra doc to know if there is a next page
+    items = list(project(model_cls_name, rsp, fields, exclude).limit(page_size + 1))
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1], sort_field)
+    docs = [to_dict(item) for item in items]
+    body = {
+        'count': total,
+        'page_size': page_size,
+        'after': after,
+        'next_cursor': next_cursor,
+        'items': docs,
+    }
+    return body
+
+
+def get_item(model_cls_name, fields=None, exclude=None, **kwargs):
     """
     Get one (first document) matching kwargs. Typically this is called
     primary/unique key like id in kwargs that should result on only one
     document. However this is flexible to return just the first document
+    fields and exclude are the same as in get_all_items
     """
-    item = model_cls_name.objects(**kwargs).first()
+    rsp = model_cls_name.objects(**kwargs)
+    item = project(model_cls_name, rsp, fields, exclude).first()
     if item:
-        item = json.loads(item.to_json())
-        item['id'] = item['_id']['$oid']
-        item.pop('_id', None)
-        item['date_added'] = item['date_added']['$date']
-        item['date_modified'] = item['date_modified']['$date']
-        return item
+        return to_dict(item)
+
+
+# the paging arguments of get_all_items, not used when exporting
+PAGING_ARGS = ('page', 'page_size', 'sort', 'after', 'count')
+
+
+def iter_items(model_cls_name, batch_size=500, fields=None, exclude=None, **kwargs):
+    """
+    Generator of all the documents matching kwargs (same as get_all_items)
+    read from a cursor batch_size documents at a time, to go over a whole
+    collection in constant memory. The query is checked before the
+    generator is returned, ValueError is raised for an unknown field or an
+    invalid value
+    """
+    for key in PAGING_ARGS:
+        kwargs.pop(key, None)
+    exclude = request_exclude(model_cls_name, exclude)
+    for key in kwargs:
+        field = key.split('__')[0]
+        if key != 'search' and field not in model_cls_name._fields and field != 'id':
+            raise ValueError("unknown field %s" % field)
+    batch_size = int(batch_size)
+    if 'search' in kwargs:
+        search = kwargs.pop('search')
+        rsp = model_cls_name.objects(**kwargs).filter(__raw__=search_query(search))
+    else:
+        rsp = model_cls_name.objects(**kwargs)
+    rsp = project(model_cls_name, rsp.order_by('id'), fields, exclude)
+    try:
+        # builds the mongo query, the values are converted and validated
+        rsp._query
+    except (InvalidQueryError, LookUpError, ValidationError) as e:
+        raise ValueError(str(e))
+
+    def docs():
+        for doc in rsp.batch_size(batch_size):
+            yield to_dict(doc)
+    return docs()
+
+
+def update_counter(model_cls_name, key_counts):
+    """
+    Models with counted_in = (parent model name, key field, count field)
+    have the count of their documents kept in the parent document whose
+    name is the value of the key field. key_counts is a dict of key value
+    to the number of documents added (or removed if negative)
+    """
+    counted_in = getattr(model_cls_name, 'counted_in', None)
+    if not counted_in:
+        return
+    parent_cls_name, _, count_field = counted_in
+    parent_cls = get_document(parent_cls_name)
+    key_counts = {key: count for key, count in key_counts.items() if count}
+    for key, count in key_counts.items():
+        parent_cls.objects(name=key).update_one(**{'inc__' + count_field: count})
+    if key_counts:
+        bump_version(parent_cls)
+
+
+def count_keys(model_cls_name, docs):
+    """
+    Number of docs (dicts) per value of the counted_in key field
+    """
+    key_counts = {}
+    counted_in = getattr(model_cls_name, 'counted_in', None)
+    if counted_in:
+        for doc in docs:
+            key = doc.get(counted_in[1])
+            key_counts[key] = key_counts.get(key, 0) + 1
+    return key_counts
+
+
+def repair_counter(model_cls_name):
+    """
+    Recount the documents per key and fix the parents whose count is off.
+    Returns the list of (parent name, stored count, actual count) fixed
+    """
+    counted_in = getattr(model_cls_name, 'counted_in', None)
+    if not counted_in:
+        return []
+    parent_cls_name, key_field, count_field = counted_in
+    parent_cls = get_document(parent_cls_name)
+    counts = {}
+    for row in model_cls_name._get_collection().aggregate([
+            {'$group': {'_id': '$' + key_field, 'count': {'$sum': 1}}}]):
+        counts[row['_id']] = row['count']
+    fixed = []
+    for parent in parent_cls.objects.only('name', count_field).as_pymongo():
+        stored = parent.get(count_field) or 0
+        actual = counts.get(parent['name'], 0)
+        if stored != actual:
+            parent_cls.objects(name=parent['name']).update_one(**{'set__' + count_field: actual})
+            fixed.append((parent['name'], stored, actual))
+    if fixed:
+        bump_version(parent_cls)
+    return fixed
+
+
+def prepare_data(model_cls_name, data):
+    """
+    Let the model validate data and set its computed fields before a write
+    (eg. Address ranges)
+    """
+    prepare = getattr(model_cls_name, 'prepare_data', None)
+    if prepare:
+        prepare(data)
 
 
 def create_item(model_cls_name, exclude_search=None, **kwargs):
+    prepare_data(model_cls_name, kwargs)
     item = model_cls_name(**kwargs)
-    # add all the values to search field
-    item.search = make_search_string(exclude_search, **kwargs)
+    item.search_tokens = search_tokens(model_cls_name, kwargs, exclude_search)
     item.date_added = datetime.datetime.utcnow()
     item.date_modified = datetime.datetime.utcnow()
-    item.save()        
+    item.save()
+    bump_version(model_cls_name)
+    update_counter(model_cls_name, count_keys(model_cls_name, [kwargs]))
+
+
+def check_items(items):
+    """
+    Check that the items of a bulk request are a list of dicts, QueryError
+    with the index of the first item that is not
+    """
+    if not isinstance(items, list):
+        raise QueryError("items must be a list")
+    for idx, data in enumerate(items):
+        if not isinstance(data, dict):
+            raise QueryError("item %d is not an object" % idx)
+
+
+def bulk_documents(model_cls_name, items, exclude_search=None):
+    """
+    Validate items (list of dicts) and return the list of (index, mongo doc)
+    of the valid ones and the list of errors of the others
+    """
+    check_items(items)
+    now = datetime.datetime.utcnow()
+    docs = []
+    errors = []
+    for idx, data in enumerate(items):
+        try:
+            prepare_data(model_cls_name, data)
+            item = model_cls_name(**data)
+            item.search_tokens = search_tokens(model_cls_name, data, exclude_search)
+            item.date_added = now
+            item.date_modified = now
+            item.validate()
+        except (FieldDoesNotExist, ValidationError) as e:
+            errors.append({'index': idx, 'error': str(e)})
+            continue
+        docs.append((idx, item.to_mongo().to_dict()))
+    return docs, errors
+
+
+def bulk_write_errors(docs, e):
+    # map the write errors back to the index in the request items
+    return [{'index': docs[err['index']][0], 'error': err['errmsg']}
+            for err in e.details.get('writeErrors', [])]
+
+
+def bulk_create(model_cls_name, items, exclude_search=None):
+    """
+    Insert items (list of dicts) with one unordered insert_many. The items
+    that fail validation or the insert (eg. duplicate keys) are reported in
+    errors with their index in items, the rest are inserted
+    """
+    docs, errors = bulk_documents(model_cls_name, items, exclude_search)
+    inserted = 0
+    if docs:
+        collection = model_cls_name._get_collection()
+        failed = set()
+        try:
+            rsp = collection.insert_many([doc for _, doc in docs], ordered=False)
+            inserted = len(rsp.inserted_ids)
+        except BulkWriteError as e:
+            inserted = e.details['nInserted']
+            failed = set(err['index'] for err in e.details.get('writeErrors', []))
+            errors.extend(bulk_write_errors(docs, e))
+        bump_version(model_cls_name)
+        update_counter(model_cls_name, count_keys(model_cls_name,
+            [doc for idx, (_, doc) in enumerate(docs) if idx not in failed]))
+    return {'inserted': inserted, 'errors': errors}
+
+
+def bulk_upsert(model_cls_name, items, key_fields, exclude_search=None):
+    """
+    Insert or update items (list of dicts) matched on key_fields with one
+    unordered bulk_write. Errors are reported as in bulk_create
+    """
+    docs, errors = bulk_documents(model_cls_name, items, exclude_search)
+    rsp = {'inserted': 0, 'modified': 0, 'errors': errors}
+    if not docs:
+        return rsp
+    requests = []
+    for _, doc in docs:
+        query = {key: doc.get(key) for key in key_fields}
+        date_added = doc.pop('date_added')
+        requests.append(UpdateOne(query, {
+            '$set': doc,
+            '$setOnInsert': {'date_added': date_added}
+        }, upsert=True))
+    collection = model_cls_name._get_collection()
+    try:
+        result = collection.bulk_write(requests, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        result = e.details
+        errors.extend(bulk_write_errors(docs, e))
+    bump_version(model_cls_name)
+    rsp['inserted'] = result['nUpserted']
+    rsp['modified'] = result['nModified']
+    # only the inserted docs are counted
+    update_counter(model_cls_name, count_keys(model_cls_name,
+        [docs[row['index']][1] for row in result.get('upserted', [])]))
+    return rsp
 
 
 def update_item(model_cls_name, src_item_query, exclude_search=None, upsert=False, **kwargs):
@@ -88,22 +593,49 @@ def update_item(model_cls_name, src_item_query, exclude_search=None, upsert=Fals
     as required by mongoengine
     """
     # ignore the base class attributes in the kwargs
-    implicit_keys = ['date_added', 'date_modified', 'search', 'id', '_id']
+    implicit_keys = ['date_added', 'date_modified', 'search', 'search_tokens', 'id', '_id']
     for key in implicit_keys:
         kwargs.pop(key, None)
     kwargs['date_modified'] = datetime.datetime.utcnow()
+    prepare_data(model_cls_name, kwargs)
+    search_fields = set(model_cls_name.search_fields)
+    updated_fields = search_fields & set(kwargs)
+    # the values of the fields matched by the query are known too
+    known = {key: value for key, value in src_item_query.items() if key in model_cls_name._fields}
+    known.update(kwargs)
+    complete = search_fields <= set(known)
+    if updated_fields and complete:
+        # all the search values are known, update the tokens along
+        kwargs['search_tokens'] = search_tokens(model_cls_name, known, exclude_search)
     item = model_cls_name.objects(**src_item_query).modify(new=True, upsert=upsert, **kwargs)
-    # add search with the modified items
-    json_item = json.loads(item.to_json())
-    for key in implicit_keys:
-        json_item.pop(key, None)
-    item.search = make_search_string(exclude_search, **json_item)
-    item.save()
+    if item is None:
+        return item
+    if updated_fields and not complete:
+        # only some of the search values changed, the tokens need the others
+        # from the updated item
+        item.search_tokens = search_tokens(model_cls_name, item.to_mongo(), exclude_search)
+        model_cls_name.objects(id=item.id).update_one(set__search_tokens=item.search_tokens)
+    bump_version(model_cls_name)
     return item
 
 
 def delete_item(model_cls_name, **kwargs):
-    model_cls_name.objects(**kwargs).delete()
+    rsp = model_cls_name.objects(**kwargs)
+    counted_in = getattr(model_cls_name, 'counted_in', None)
+    key_counts = {}
+    if not counted_in:
+        rsp.delete()
+    elif counted_in[1] in kwargs:
+        deleted = rsp.delete()
+        key_counts[kwargs[counted_in[1]]] = -deleted
+    else:
+        for row in model_cls_name._get_collection().aggregate([
+                {'$match': rsp._query},
+                {'$group': {'_id': '$' + counted_in[1], 'count': {'$sum': 1}}}]):
+            key_counts[row['_id']] = -row['count']
+        rsp.delete()
+    bump_version(model_cls_name)
+    update_counter(model_cls_name, key_counts)
 
 
 def distinct_items(model_cls_name):
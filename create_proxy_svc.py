@@ -1,16 +1,27 @@
 """
-Create proxy service for a given kube service's cluster ip and port
+Create proxy service for a given kube service's cluster ip and ports
 """
 import base64
+import concurrent.futures
 import datetime
+import difflib
+import hashlib
+import json
 import os
-import shutil
-import tarfile
-import tempfile
+import re
+import socket
+import threading
+import time
 from jinja2 import Template
-from kubernetes import config, client
+from kubernetes import client
+from mongoengine import Q
 import yaml
+import base_query
+import crs_rules
+import kube_clients
 import models
+import policy_compiler
+import waf_bundle
 
 proxy_deployment_template = """
 apiVersion: apps/v1
@@ -21,13 +32,19 @@ spec:
   selector:
     matchLabels:
       run: {{proxy_name}}
-  replicas: 2
+  {%- if not perf.hpa_max_replicas %}
+  replicas: {{perf.replicas}}
+  {%- endif %}
   template:
     metadata:
       labels:
         run: {{proxy_name}}
-        updated: {{date_time}}
+      annotations:
+        sbf/config-hash: "{{config_hash}}"
     spec:
+      {%- if reload_upstreams %}
+      shareProcessNamespace: true
+      {%- endif %}
       initContainers:
       - name: setup-rules
         image: alpine
@@ -41,11 +58,37 @@ spec:
       - name: {{proxy_name}}
         image: owasp/modsecurity:3.0-nginx
         ports:
-        - containerPort: 80
+        {%- for port in ports %}
+        - containerPort: {{port}}
+        {%- endfor %}
+        {%- if perf.cpu_request or perf.memory_request or perf.cpu_limit or perf.memory_limit %}
+        resources:
+          {%- if perf.cpu_request or perf.memory_request %}
+          requests:
+            {%- if perf.cpu_request %}
+            cpu: "{{perf.cpu_request}}"
+            {%- endif %}
+            {%- if perf.memory_request %}
+            memory: "{{perf.memory_request}}"
+            {%- endif %}
+          {%- endif %}
+          {%- if perf.cpu_limit or perf.memory_limit %}
+          limits:
+            {%- if perf.cpu_limit %}
+            cpu: "{{perf.cpu_limit}}"
+            {%- endif %}
+            {%- if perf.memory_limit %}
+            memory: "{{perf.memory_limit}}"
+            {%- endif %}
+          {%- endif %}
+        {%- endif %}
         volumeMounts:
         - name: nginx-conf
           mountPath: /etc/nginx/nginx.conf
           subPath: nginx.conf
+        - name: nginx-conf
+          mountPath: /etc/nginx/policy.conf
+          subPath: policy.conf
         - name: nginx-conf
           mountPath: /etc/modsecurity.d/modsecurity.conf
           subPath: modsecurity.conf
@@ -57,13 +100,38 @@ spec:
           subPath: crs-setup.conf
         - name: crs-rules
           mountPath: /etc/modsecurity.d/crs/rules
+        - name: nginx-upstreams
+          mountPath: /etc/nginx/upstreams
+      {%- if reload_upstreams %}
+      - name: reload-upstreams
+        image: alpine
+        volumeMounts:
+        - name: nginx-upstreams
+          mountPath: /etc/nginx/upstreams
+        command:
+        - sh
+        - -c
+        - |
+          last=""
+          while true; do
+            sum=$(md5sum /etc/nginx/upstreams/upstreams.conf)
+            if [ -n "$last" ] && [ "$sum" != "$last" ]; then
+              pkill -HUP -f 'nginx: master'
+            fi
+            last=$sum
+            sleep 5
+          done
+      {%- endif %}
       volumes:
       - name: nginx-conf
         configMap:
           name: {{proxy_name}}
+      - name: nginx-upstreams
+        configMap:
+          name: {{proxy_name}}-upstreams
       - name: rules-tgz
         secret:
-          secretName: {{proxy_name}}
+          secretName: {{rules_secret}}
       - name: crs-rules
         emptyDir: {}
 """
@@ -79,12 +147,30 @@ spec:
   type: LoadBalancer
   externalTrafficPolicy: Local
   ports:
-  - port: 80
+  {%- for port in ports %}
+  - name: p{{port}}
+    port: {{port}}
     protocol: TCP
+  {%- endfor %}
   selector:
     run: {{proxy_name}}
 """
 
+proxy_hpa_template = """
+apiVersion: autoscaling/v1
+kind: HorizontalPodAutoscaler
+metadata:
+  name: {{proxy_name}}
+spec:
+  scaleTargetRef:
+    apiVersion: apps/v1
+    kind: Deployment
+    name: {{proxy_name}}
+  minReplicas: {{perf.hpa_min_replicas}}
+  maxReplicas: {{perf.hpa_max_replicas}}
+  targetCPUUtilizationPercentage: {{perf.hpa_cpu_target}}
+"""
+
 proxy_config_template = """
 apiVersion: v1
 kind: ConfigMap
@@ -93,6 +179,8 @@ metadata:
 data:
   nginx.conf: |
     {{nginx_conf | indent(4)}}
+  policy.conf: |
+    {{policy_conf | indent(4)}}
   include.conf: |
     {{modsec_include | indent(4)}}
   modsecurity.conf: |
@@ -101,6 +189,16 @@ data:
     {{crs_setup_conf | indent(4)}}
 """
 
+proxy_upstreams_template = """
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: {{config_name}}
+data:
+  upstreams.conf: |
+    {{upstreams_conf | indent(4)}}
+"""
+
 proxy_secrets_template = """
 apiVersion: v1
 kind: Secret
@@ -111,117 +209,512 @@ data:
     {{rules_b64 | indent(4)}}
 """
 
-def prepare_waf_rulesets(waf_profile_name):
-    # include *.data, REQUEST-90*, RESPONSE-980-CORRELATION
-    _, tmp_file_name = tempfile.mkstemp()
-    tmp_file_name = tmp_file_name + '.tgz'
-    dst_rulesdir = tempfile.mkdtemp()
-    src_rulesdir = os.path.join('modsec', 'rules')
-    for fname in os.listdir(src_rulesdir):
-        if fname.endswith('.data') or fname.startswith('REQUEST-90') or fname.startswith('RESPONSE-980') or fname.startswith('REQUEST-949') or fname.startswith('REQUEST-959'):
-            shutil.copy2(os.path.join(src_rulesdir, fname), dst_rulesdir)
+shared_bundle_template = """
+apiVersion: v1
+kind: Secret
+metadata:
+  name: {{bundle_name}}
+  labels:
+    sbf/waf-bundle: "true"
+    sbf/waf-profile: "{{profile_label}}"
+    sbf/bundle-hash: "{{bundle_hash}}"
+immutable: true
+data:
+  rules.tgz: |
+    {{rules_b64 | indent(4)}}
+"""
+
+# service: a rules secret per proxy, shared: one secret per namespace,
+# waf profile and bundle hash that the proxies of the profile mount
+BUNDLE_MODE = os.getenv('SBF_BUNDLE_MODE', 'service')
+# seconds an unused shared bundle is kept after it was created or last
+# used by a render, the pods of a rollout in progress may still mount it
+BUNDLE_GC_GRACE = int(os.getenv('SBF_BUNDLE_GC_GRACE', 600))
+# annotation with the time a render last used the shared bundle
+BUNDLE_USED_ANNOTATION = 'sbf/last-used'
+
+# create: create the objects and patch the ones that exist, apply: one
+# server-side apply request per object owned by FIELD_MANAGER
+APPLY_MODE = os.getenv('SBF_APPLY_MODE', 'create')
+FIELD_MANAGER = os.getenv('SBF_FIELD_MANAGER', 'sbf-api')
+APPLY_CONTENT_TYPE = 'application/apply-patch+yaml'
+# objects of a service applied concurrently, 1 applies them in order
+APPLY_WORKERS = int(os.getenv('SBF_APPLY_WORKERS', 1))
+
+# seconds after which all the proxy objects are applied again even if
+# their rendered hash did not change, restoring the objects edited or
+# deleted out of band and refreshing the proxy ips
+RESYNC_INTERVAL = int(os.getenv('SBF_PROXY_RESYNC_INTERVAL', 3600))
+
+# seconds a render holds the lock of its service, the lock of a process
+# that exited is taken over after it
+LOCK_TIMEOUT = int(os.getenv('SBF_PROXY_LOCK_TIMEOUT', 300))
+# seconds a render waits for the lock before it fails
+LOCK_WAIT = int(os.getenv('SBF_PROXY_LOCK_WAIT', 2 * LOCK_TIMEOUT))
+LOCK_POLL = 0.5
+
+
+class LockTimeout(RuntimeError):
+    pass
+
+
+# manifest kind -> (kube_clients api, object name in the api methods)
+KIND_APIS = {
+    'config': (kube_clients.core_api, 'config_map'),
+    'upstreams': (kube_clients.core_api, 'config_map'),
+    'secret': (kube_clients.core_api, 'secret'),
+    'deployment': (kube_clients.apps_api, 'deployment'),
+    'hpa': (kube_clients.autoscaling_api, 'horizontal_pod_autoscaler'),
+    'service': (kube_clients.core_api, 'service'),
+}
+
+RULES_DIR = os.path.join('modsec', 'rules')
+CRS_SETUP = os.path.join('modsec', 'crs-setup.conf')
+MODSEC_CONF = os.path.join('modsec', 'modsecurity.conf')
+# setup of the waf profile, loaded before REQUEST-901-INITIALIZATION so
+# that it does not set its defaults
+PROFILE_SETUP_FILE = 'REQUEST-900-SBF-PROFILE.conf'
+# rule id of the profile setup, crs-setup.conf uses the 9009xx ids up to 900990
+PROFILE_SETUP_RULE_ID = 900995
+
+profile_setup_template = """# settings of the waf profile
+SecAction \\
+    "id:{{rule_id}},\\
+    phase:1,\\
+    nolog,\\
+    pass,\\
+    t:none,\\
+    setvar:tx.paranoia_level={{paranoia_level}},\\
+    {%- if inbound_anomaly_threshold %}
+    setvar:tx.inbound_anomaly_score_threshold={{inbound_anomaly_threshold}},\\
+    {%- endif %}
+    {%- if outbound_anomaly_threshold %}
+    setvar:tx.outbound_anomaly_score_threshold={{outbound_anomaly_threshold}},\\
+    {%- endif %}
+    setvar:tx.executing_paranoia_level={{paranoia_level}}"
+"""
+
+
+def waf_rule_files(waf_profile_name):
+    # include REQUEST-90*, the blocking evaluations, RESPONSE-980-CORRELATION
+    # and the rule sets of the profile. The .data files are added for the
+    # rules that use them (prepare_waf_rulesets)
+    file_names = []
+    for fname in os.listdir(RULES_DIR):
+        if not fname.endswith('.conf'):
+            continue
+        if fname.startswith('REQUEST-90') or fname.startswith('RESPONSE-980') or fname.startswith('REQUEST-949') or fname.startswith('RESPONSE-959'):
+            file_names.append(fname)
     # find the rule file names defined in waf_profile_name
     for rule in models.WafProfileRuleSet.objects(profile_name=waf_profile_name):
-        fname = rule.rule_set_name + '.conf'
-        shutil.copy2(os.path.join(src_rulesdir, fname), dst_rulesdir)
-    with tarfile.open(tmp_file_name, "w:gz") as tar:
-        tar.add(dst_rulesdir, arcname="")
-    shutil.rmtree(dst_rulesdir)
-    return tmp_file_name
+        file_names.append(rule.rule_set_name + '.conf')
+    return file_names
+
+
+def waf_settings(waf_profile_name):
+    """
+    Paranoia level, excluded rule ids and anomaly thresholds of the waf
+    profile. The paranoia level defaults to the one of crs-setup.conf
+    """
+    profile = models.WafProfile.objects(name=waf_profile_name).first()
+    paranoia_level = profile.paranoia_level if profile else None
+    if not paranoia_level:
+        with open(CRS_SETUP) as fd:
+            paranoia_level = crs_rules.paranoia_level(fd.read())
+    return {
+        'paranoia_level': paranoia_level,
+        'excluded_rule_ids': sorted(profile.excluded_rule_ids) if profile else [],
+        'inbound_anomaly_threshold': profile.inbound_anomaly_threshold if profile else None,
+        'outbound_anomaly_threshold': profile.outbound_anomaly_threshold if profile else None,
+    }
+
+
+def prepare_waf_bundle(waf_profile_name):
+    """
+    Return (bundle key, base64 of the rules tgz) for the waf profile. The rules
+    above the paranoia level of the profile and its excluded rule ids are
+    left out, and only the .data files of the remaining rules are shipped.
+    The bundles are cached by their contents (waf_bundle) so the services
+    with the same rule sets and settings share one tarball
+    """
+    settings = waf_settings(waf_profile_name)
+    rules = {}
+    data_files = set()
+    for fname in waf_rule_files(waf_profile_name):
+        rules[fname] = crs_rules.prune(crs_rules.parse_path(os.path.join(RULES_DIR, fname)),
+                                       settings['paranoia_level'], settings['excluded_rule_ids'])
+        data_files.update(crs_rules.data_files(rules[fname]))
+    available = set(os.listdir(RULES_DIR))
+    file_names = list(rules) + sorted(data_files & available)
+    profile_setup = Template(profile_setup_template).render(rule_id=PROFILE_SETUP_RULE_ID, **settings)
+
+    def contents():
+        # the proxy loads modsecurity.conf, crs-setup.conf and the bundle,
+        # a rule id defined twice fails the loading of all the rules
+        duplicates = crs_rules.duplicate_ids(
+            [crs_rules.parse_path(MODSEC_CONF), crs_rules.parse_path(CRS_SETUP),
+             crs_rules.parse_file(PROFILE_SETUP_FILE, profile_setup)] + list(rules.values()))
+        if duplicates:
+            raise ValueError("rule ids defined more than once in the waf bundle: %s"
+                             % ', '.join(map(str, duplicates)))
+        files = {fname: crs_rules.render(file_rules).encode() for fname, file_rules in rules.items()}
+        files[PROFILE_SETUP_FILE] = profile_setup.encode()
+        return files
+    return waf_bundle.get_bundle(RULES_DIR, file_names, extra=dict(settings, profile_setup=profile_setup),
+                                 contents=contents)
+
+
+def prepare_waf_rulesets(waf_profile_name):
+    """
+    Return the base64 of the rules tgz for the waf profile
+    """
+    _, rules_b64 = prepare_waf_bundle(waf_profile_name)
+    return rules_b64
+
+
+def unique_ports(app_svc):
+    # the ports of the app svc, a port number listed for several protocols
+    # (eg. 53 TCP and UDP) once as the proxy listens on TCP only
+    ports = {}
+    for port in app_svc.ports:
+        ports.setdefault(port['port'], port)
+    return list(ports.values())
+
+
+def proxy_ports(app_svc):
+    # the proxy listens on the same ports as the app svc
+    return [port['port'] for port in unique_ports(app_svc)]
+
+
+def get_endpoints(app_svc):
+    """
+    Return {service port name: [ip:port, ..]} of the ready pod endpoints
+    of the app svc
+    """
+    v1 = kube_clients.core_api(app_svc.kube_profile)
+    endpoints = v1.read_namespaced_endpoints(name=app_svc.name, namespace=app_svc.namespace)
+    servers = {}
+    for subset in endpoints.subsets or []:
+        for port in subset.ports or []:
+            if (port.protocol or 'TCP') != 'TCP':
+                continue
+            for addr in subset.addresses or []:
+                servers.setdefault(port.name, []).append("%s:%d" % (addr.ip, port.port))
+    return servers
 
 
-def prepare_config_map(app_svc):
-    upstream = app_svc.cluster_ip + ":" + str(app_svc.ports[0]['port'])
+def uses_endpoints(app_svc):
+    # ip_hash does not allow a backup server, it always uses the cluster ip
+    return app_svc.proxy_upstream_mode == 'endpoints' and app_svc.proxy_lb_method != 'ip_hash'
+
+
+def prepare_upstreams(app_svc):
+    """
+    One upstream per app svc port. In the endpoints mode the upstream has
+    the pod endpoints (skipping the kube-proxy hop) with the cluster ip as
+    backup. The proxy is rendered again when the endpoints change
+    (update_kube_services.watch_endpoints)
+    """
+    endpoints = {}
+    if uses_endpoints(app_svc):
+        endpoints = get_endpoints(app_svc)
+    ports = unique_ports(app_svc)
+    upstreams = []
+    for port in ports:
+        cluster_ip_port = "%s:%d" % (app_svc.cluster_ip, port['port'])
+        servers = endpoints.get(port.get('name'))
+        if servers is None and len(ports) == 1 and len(endpoints) == 1:
+            # single unnamed port
+            servers = list(endpoints.values())[0]
+        backup = None
+        if servers:
+            servers = sorted(servers)
+            backup = cluster_ip_port
+        else:
+            servers = [cluster_ip_port]
+        upstreams.append({
+            'name': "%s-%d" % (app_svc.name, port['port']),
+            'listen': port['port'],
+            'servers': servers,
+            'backup': backup,
+        })
+    return upstreams
+
+
+def get_performance_profile(app_svc):
+    """
+    PerformanceProfile of the app svc, the defaults if it has none
+    """
+    perf = None
+    if app_svc.proxy_performance_profile:
+        perf = models.PerformanceProfile.objects(name=app_svc.proxy_performance_profile).first()
+    if perf is None:
+        perf = models.PerformanceProfile(name="default")
+    return perf
+
+
+def prepare_config_map(app_svc, upstreams=None):
+    if upstreams is None:
+        upstreams = prepare_upstreams(app_svc)
     nginx_conf = Template(open('modsec/nginx.conf').read()).render(
-        cluster_ip_port=upstream, upstream_name=app_svc.name)
+        upstreams=upstreams, perf=get_performance_profile(app_svc))
     modsec_include = open('modsec/include.conf').read()
     modsec_conf = open('modsec/modsecurity.conf').read()
     crs_setup_conf = open('modsec/crs-setup.conf').read()
+    # source ip allow/drop of the policy profile
+    policy_conf = policy_compiler.compile_policy(app_svc.proxy_policy_profile)
     t = Template(proxy_config_template)
     config_name = "proxy-" + app_svc.name
     body = t.render(proxy_name=config_name,
-        nginx_conf=nginx_conf, modsec_include=modsec_include,
+        nginx_conf=nginx_conf, policy_conf=policy_conf, modsec_include=modsec_include,
         modsec_conf=modsec_conf, crs_setup_conf=crs_setup_conf)
     return body
 
 
+def prepare_upstreams_config(app_svc, upstreams, perf):
+    # the upstream servers, in their own config map mounted as a directory
+    # so that the kubelet updates the file in the running pods
+    upstreams_conf = Template(open('modsec/upstreams.conf').read()).render(
+        upstreams=upstreams, lb_method=app_svc.proxy_lb_method, perf=perf)
+    t = Template(proxy_upstreams_template)
+    return t.render(config_name="proxy-%s-upstreams" % app_svc.name, upstreams_conf=upstreams_conf)
+
+
 def prepare_secrets(app_svc):
     # prepare waf rule sets
-    rules_tar_file = prepare_waf_rulesets(app_svc.proxy_waf_profile)
-    rules_b64 = base64.b64encode(open(rules_tar_file, "rb").read()).decode()
+    rules_b64 = prepare_waf_rulesets(app_svc.proxy_waf_profile)
     config_name = "proxy-" + app_svc.name
     t = Template(proxy_secrets_template)
     body = t.render(proxy_name=config_name, rules_b64=rules_b64)
     return body
 
 
-def create_proxy_config(app_svc):
-    config_name = "proxy-" + app_svc.name
-    body = prepare_config_map(app_svc)
-    body = yaml.safe_load(body)
-    v1 = client.CoreV1Api()
-    try:
-        v1.create_namespaced_config_map(body=body, namespace=app_svc.namespace)
-    except client.rest.ApiException as e:
-        if e.reason == "Conflict":
-            v1.patch_namespaced_config_map(
-                name=config_name, body=body, namespace=app_svc.namespace)
-        else:
-            raise(e)
+def label_value(value):
+    # kube label values: 63 chars of alphanumerics, '-', '_', '.'
+    return re.sub(r'[^A-Za-z0-9_.-]', '-', value)[:63].strip('-_.')
 
 
-def create_proxy_secrets(app_svc):
-    config_name = "proxy-" + app_svc.name
-    body = prepare_secrets(app_svc)
-    body = yaml.safe_load(body)
-    v1 = client.CoreV1Api()
-    try:
-        v1.create_namespaced_secret(body=body, namespace=app_svc.namespace)
-    except client.rest.ApiException as e:
-        if e.reason == "Conflict":
-            v1.patch_namespaced_secret(
-                name=config_name, body=body, namespace=app_svc.namespace)
-        else:
-            raise(e)
+def shared_bundle_name(waf_profile_name, key):
+    slug = re.sub(r'[^a-z0-9-]', '-', (waf_profile_name or 'none').lower())[:40].strip('-')
+    return "sbf-waf-%s-%s" % (slug, key[:12])
+
+
+def bundle_last_used(secret):
+    # creation or last use of the shared bundle secret, as a utc datetime
+    last_used = secret.metadata.creation_timestamp
+    used = (secret.metadata.annotations or {}).get(BUNDLE_USED_ANNOTATION)
+    if used:
+        used = datetime.datetime.strptime(used, '%Y-%m-%dT%H:%M:%SZ').replace(
+            tzinfo=datetime.timezone.utc)
+        if last_used is None or used > last_used:
+            last_used = used
+    return last_used
+
+
+def gc_shared_bundles(kube_profile_name, namespace):
+    """
+    Delete the shared bundles of the namespace that no service uses and
+    that were not created or used by a render for BUNDLE_GC_GRACE. A render
+    marks the bundle used before its deployment mounts it, the service doc
+    tells only once the render is saved
+    """
+    used = set(models.Service.objects(kube_profile=kube_profile_name, namespace=namespace)
+               .distinct('proxy_rules_bundle'))
+    v1 = kube_clients.core_api(kube_profile_name)
+    bundles = v1.list_namespaced_secret(namespace=namespace, label_selector='sbf/waf-bundle=true')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    deleted = []
+    for secret in bundles.items:
+        name = secret.metadata.name
+        last_used = bundle_last_used(secret)
+        if name in used or (last_used and (now - last_used).total_seconds() < BUNDLE_GC_GRACE):
+            continue
+        delete_ignore_missing(v1.delete_namespaced_secret, name, namespace)
+        deleted.append(name)
+    return deleted
+
+
+def prepare_shared_bundle(app_svc):
+    # the rules of the waf profile as the shared bundle secret of the
+    # namespace. The bundle is never modified, a new bundle gets a new name
+    key, rules_b64 = prepare_waf_bundle(app_svc.proxy_waf_profile)
+    t = Template(shared_bundle_template)
+    body = t.render(bundle_name=shared_bundle_name(app_svc.proxy_waf_profile, key),
+        profile_label=label_value(app_svc.proxy_waf_profile or ''),
+        bundle_hash=key[:12], rules_b64=rules_b64)
+    return body
 
 
-def create_proxy_deployment(app_svc):
-    # create a pod that reverse proxies to the app_svc
+def prepare_deployment(app_svc, config_hash, rules_secret, perf):
+    # a pod that reverse proxies to the app_svc. In the endpoints mode a
+    # sidecar reloads nginx when the upstreams file changes
     t = Template(proxy_deployment_template)
-    deployment_name = "proxy-" + app_svc.name
-    cur_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    body = t.render(proxy_name=deployment_name, date_time="t"+cur_time)
-    body = yaml.safe_load(body)
-    v1 = client.AppsV1Api()
+    body = t.render(proxy_name="proxy-" + app_svc.name, config_hash=config_hash,
+        rules_secret=rules_secret, ports=proxy_ports(app_svc), perf=perf,
+        reload_upstreams=uses_endpoints(app_svc))
+    return body
+
+
+def prepare_proxy_svc(app_svc):
+    t = Template(proxy_service_template)
+    body = t.render(proxy_name="proxy-" + app_svc.name, ports=proxy_ports(app_svc))
+    return body
+
+
+def manifest_hash(body):
+    return hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def is_shared_bundle(body):
+    return body['metadata'].get('labels', {}).get('sbf/waf-bundle') == 'true'
+
+
+def proxy_manifests(app_svc):
+    """
+    Render the manifests of the proxy of the app svc, a list of {kind,
+    name, body, hash} in the order they are applied. The kinds are config,
+    upstreams, secret, deployment, hpa and service, the hpa body is None
+    when the performance profile has no hpa. Nothing is applied
+    """
+    proxy_name = "proxy-" + app_svc.name
+    perf = get_performance_profile(app_svc)
+    upstreams = prepare_upstreams(app_svc)
+    config = yaml.safe_load(prepare_config_map(app_svc, upstreams))
+    upstreams_config = yaml.safe_load(prepare_upstreams_config(app_svc, upstreams, perf))
+    upstreams_hash = manifest_hash(upstreams_config)
+    if BUNDLE_MODE == 'shared':
+        secret = yaml.safe_load(prepare_shared_bundle(app_svc))
+        rules_secret = secret['metadata']['name']
+        # the bundle name has the hash of the rules
+        secret_hash = manifest_hash({'bundle': rules_secret})
+    else:
+        secret = yaml.safe_load(prepare_secrets(app_svc))
+        rules_secret = proxy_name
+        secret_hash = manifest_hash(secret)
+    config_hash = manifest_hash(config)
+    # the pods are rolled only when the config or the rules change. The
+    # endpoints change with every app pod, their upstreams are reloaded by
+    # the sidecar of the proxy instead
+    pod_hashes = [config_hash, secret_hash]
+    if not uses_endpoints(app_svc):
+        pod_hashes.append(upstreams_hash)
+    deployment = yaml.safe_load(prepare_deployment(
+        app_svc, manifest_hash(pod_hashes), rules_secret, perf))
+    hpa = None
+    if perf.hpa_max_replicas:
+        # autoscale the proxy deployment
+        hpa = yaml.safe_load(Template(proxy_hpa_template).render(proxy_name=proxy_name, perf=perf))
+    manifests = [
+        {'kind': 'config', 'name': proxy_name, 'body': config, 'hash': config_hash},
+        {'kind': 'upstreams', 'name': proxy_name + '-upstreams', 'body': upstreams_config,
+         'hash': upstreams_hash},
+        {'kind': 'secret', 'name': rules_secret, 'body': secret, 'hash': secret_hash},
+        {'kind': 'deployment', 'name': proxy_name, 'body': deployment},
+        {'kind': 'hpa', 'name': proxy_name, 'body': hpa},
+        {'kind': 'service', 'name': proxy_name, 'body': yaml.safe_load(prepare_proxy_svc(app_svc))},
+    ]
+    for manifest in manifests:
+        if 'hash' not in manifest:
+            manifest['hash'] = manifest_hash(manifest['body']) if manifest['body'] else None
+    return manifests
+
+
+def is_unchanged(app_svc, kind, body_hash):
+    """
+    Check the hash of the rendered manifest against the one applied last
+    for the kind and remember the new hash on app_svc. It is saved along
+    with the svc in update_svc
+    """
+    if app_svc.proxy_hashes.get(kind) == body_hash:
+        return True
+    app_svc.proxy_hashes[kind] = body_hash
+    return False
+
+
+def kind_api(app_svc, kind, verb):
+    """
+    The <verb>_namespaced_<object> method of the api of the kind
+    """
+    api, obj = KIND_APIS[kind]
+    return getattr(api(app_svc.kube_profile), "%s_namespaced_%s" % (verb, obj))
+
+
+def apply_manifest(app_svc, manifest):
+    """
+    Create or update the object of the manifest and return it. In the
+    apply mode it is one server-side apply request whose fields are owned
+    by FIELD_MANAGER (force takes over the fields set by the create mode),
+    in the create mode the object is created and patched if it exists
+    """
+    kind = manifest['kind']
+    name = manifest['name']
+    body = manifest['body']
+    namespace = app_svc.namespace
+    if APPLY_MODE == 'apply' and not is_shared_bundle(body):
+        # a str body is sent as is, the client only serializes the json
+        # content types
+        return kind_api(app_svc, kind, 'patch')(
+            name=name, namespace=namespace, body=json.dumps(body),
+            field_manager=FIELD_MANAGER, force=True, _content_type=APPLY_CONTENT_TYPE)
     try:
-        v1.create_namespaced_deployment(body=body, namespace=app_svc.namespace)
+        return kind_api(app_svc, kind, 'create')(body=body, namespace=namespace)
     except client.rest.ApiException as e:
-        if e.reason == "Conflict":
-            v1.patch_namespaced_deployment(
-                name=deployment_name, body=body, namespace=app_svc.namespace)
-        else:
+        if e.reason != "Conflict":
             raise(e)
+    if is_shared_bundle(body):
+        # published already by another service of the profile, mark it
+        # used so that gc_shared_bundles keeps it for the rollout
+        kind_api(app_svc, kind, 'patch')(name=name, namespace=namespace, body={
+            'metadata': {'annotations': {BUNDLE_USED_ANNOTATION: datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%SZ')}}})
+        return None
+    return kind_api(app_svc, kind, 'patch')(name=name, body=body, namespace=namespace)
 
 
-def create_proxy_svc(app_svc):
-    # create svc for the proxy pods created
-    deployment_name = "proxy-" + app_svc.name
-    svc_name = "proxy-%s" % app_svc.name
-    t = Template(proxy_service_template)
-    body = t.render(proxy_name=deployment_name)
-    body = yaml.safe_load(body)
-    v1 = client.CoreV1Api()
-    rsp = None
+def apply_manifests(app_svc, manifests, force=False):
+    """
+    Apply the manifests that changed since they were applied last (all of
+    them with force), return {kind: applied object}. With APPLY_WORKERS > 1
+    the manifests are applied concurrently (after the shared bundle, that
+    is marked used before a deployment mounts it), the hash of a manifest
+    that failed is forgotten so that it is applied again
+    """
+    changed = [manifest for manifest in manifests if manifest['body'] is not None
+               and (not is_unchanged(app_svc, manifest['kind'], manifest['hash']) or force)]
+    applied = {}
+    errors = []
+
+    def apply(manifest):
+        try:
+            applied[manifest['kind']] = apply_manifest(app_svc, manifest)
+        except Exception as e:
+            app_svc.proxy_hashes.pop(manifest['kind'], None)
+            errors.append(e)
+
+    for manifest in [manifest for manifest in changed if is_shared_bundle(manifest['body'])]:
+        changed.remove(manifest)
+        apply(manifest)
+        if errors:
+            raise(errors[0])
+    if APPLY_WORKERS > 1 and len(changed) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=APPLY_WORKERS) as pool:
+            list(pool.map(apply, changed))
+    else:
+        for manifest in changed:
+            apply(manifest)
+            if errors:
+                break
+    if errors:
+        raise(errors[0])
+    return applied
+
+
+def delete_ignore_missing(delete_func, name, namespace):
     try:
-        rsp = v1.create_namespaced_service(
-            body=body, namespace=app_svc.namespace)
+        delete_func(name=name, namespace=namespace)
     except client.rest.ApiException as e:
-        if e.reason == "Conflict":
-            rsp = v1.patch_namespaced_service(
-                name=svc_name, body=body, namespace=app_svc.namespace)
-        else:
+        if e.status != 404:
             raise(e)
-    return rsp
 
 
 def update_svc(app_svc, proxy_svc):
@@ -235,14 +728,15 @@ def update_svc(app_svc, proxy_svc):
         if proxy_svc.spec.load_balancer_ip:
             app_svc.proxy_ip = [proxy_svc.spec.load_balancer_ip]
         else:
-            addr_list = get_node_ips()
+            addr_list = get_node_ips(app_svc.kube_profile)
             app_svc.proxy_ip = addr_list
             app_svc.proxy_port = proxy_svc.spec.ports[0].node_port
     app_svc.save()
+    base_query.bump_version(models.Service)
 
 
-def get_node_ips():
-    v1 = client.CoreV1Api()
+def get_node_ips(kube_profile_name):
+    v1 = kube_clients.core_api(kube_profile_name)
     addr_list = []
     for node in v1.list_node().items:
         for addr in node.status.addresses:
@@ -250,42 +744,216 @@ def get_node_ips():
     return addr_list
 
 
-def load_kube_config(app_svc):
-    kube_profile = models.KubeProfile.objects(name=app_svc.kube_profile).get()
-    tmp_fd, tmp_file_name = tempfile.mkstemp(text=True)
-    fd = os.fdopen(tmp_fd, "w")
-    fd.write(kube_profile.kube_config)
-    fd.close()
-    config.load_kube_config(tmp_file_name)
+def resync_due(app_svc):
+    if not app_svc.proxy_date_applied:
+        return True
+    age = datetime.datetime.utcnow() - app_svc.proxy_date_applied
+    return age.total_seconds() > RESYNC_INTERVAL
+
+
+def lock_owner():
+    return "%s-%d-%d" % (socket.gethostname(), os.getpid(), threading.get_ident())
+
+
+def lock_service(app_svc, owner):
+    """
+    Take the lock of the service, waiting while another render holds it.
+    The proxies are rendered by the watcher, the job workers and the fanout
+    rollouts in several processes. Return True if it had to wait, None if
+    the service was deleted meanwhile. Raise LockTimeout after LOCK_WAIT
+    """
+    waited = False
+    deadline = time.monotonic() + LOCK_WAIT
+    while True:
+        now = datetime.datetime.utcnow()
+        taken = models.Service.objects(
+            Q(proxy_lock_until=None) | Q(proxy_lock_until__lt=now), id=app_svc.id).update_one(
+            set__proxy_lock=owner,
+            set__proxy_lock_until=now + datetime.timedelta(seconds=LOCK_TIMEOUT))
+        if taken:
+            return waited
+        if not models.Service.objects(id=app_svc.id).count():
+            return None
+        if time.monotonic() > deadline:
+            raise LockTimeout("the proxy of %s is locked by another render" % app_svc.name)
+        waited = True
+        time.sleep(LOCK_POLL)
+
+
+def unlock_service(app_svc, owner):
+    models.Service.objects(id=app_svc.id, proxy_lock=owner).update_one(
+        unset__proxy_lock=True, unset__proxy_lock_until=True)
+
+
+def protect_service(app_svc, resync=False):
+    """
+    Render the proxy of the app svc and apply the objects that changed.
+    With resync (or RESYNC_INTERVAL after the last one) all the objects
+    are applied, the hashes only tell what was rendered last, not what is
+    in the cluster
+    """
+    owner = lock_owner()
+    waited = lock_service(app_svc, owner)
+    if waited is None:
+        return
+    if waited:
+        # rendered by another process meanwhile, render the latest doc
+        pending = app_svc.proxy_pending
+        app_svc.reload()
+        app_svc.proxy_pending = pending
+    try:
+        if not app_svc.deleted:
+            apply_protection(app_svc, resync)
+    finally:
+        unlock_service(app_svc, owner)
+
+
+def apply_protection(app_svc, resync):
+    resync = resync or resync_due(app_svc)
+    prev_bundle = app_svc.proxy_rules_bundle
+    manifests = proxy_manifests(app_svc)
+    by_kind = {manifest['kind']: manifest for manifest in manifests}
+    if BUNDLE_MODE == 'shared':
+        if not prev_bundle and 'secret' in app_svc.proxy_hashes:
+            # switched from the per service secret
+            v1 = kube_clients.core_api(app_svc.kube_profile)
+            delete_ignore_missing(v1.delete_namespaced_secret, "proxy-" + app_svc.name,
+                                  app_svc.namespace)
+        app_svc.proxy_rules_bundle = by_kind['secret']['name']
+    else:
+        # switched from the shared bundle, gc_shared_bundles removes it
+        app_svc.proxy_rules_bundle = ""
+    applied = apply_manifests(app_svc, manifests, force=resync)
+    if by_kind['hpa']['body'] is None and ('hpa' in app_svc.proxy_hashes or resync):
+        v1 = kube_clients.autoscaling_api(app_svc.kube_profile)
+        delete_ignore_missing(v1.delete_namespaced_horizontal_pod_autoscaler,
+                              by_kind['hpa']['name'], app_svc.namespace)
+        app_svc.proxy_hashes.pop('hpa', None)
+    if resync:
+        app_svc.proxy_date_applied = datetime.datetime.utcnow()
+    rsp = applied.get('service')
+    if rsp is None and not app_svc.proxy_svc_name:
+        rsp = kube_clients.core_api(app_svc.kube_profile).read_namespaced_service(
+            name=by_kind['service']['name'], namespace=app_svc.namespace)
+    if rsp is None:
+        # proxy svc is unchanged, only save the applied hashes
+        app_svc.save()
+        base_query.bump_version(models.Service)
+    else:
+        update_svc(app_svc, rsp)
+    if prev_bundle and prev_bundle != app_svc.proxy_rules_bundle:
+        gc_shared_bundles(app_svc.kube_profile, app_svc.namespace)
+
+
+def redact(body):
+    # the data of a secret is replaced with the hash of its value, the
+    # rules tarball is large and is not returned by the api
+    if not body or body.get('kind') != 'Secret':
+        return body
+    body = dict(body)
+    body['data'] = {key: "sha256:" + hashlib.sha256(base64.b64decode(value or '')).hexdigest()
+                    for key, value in (body.get('data') or {}).items()}
+    return body
+
 
+def live_fields(live, rendered):
+    # the fields of the live object that the manifest sets, the fields
+    # defaulted by kube (status, managedFields..) are not diffed
+    if isinstance(live, dict) and isinstance(rendered, dict):
+        return {key: live_fields(live[key], value) for key, value in rendered.items()
+                if key in live}
+    if isinstance(live, list) and isinstance(rendered, list):
+        return [live_fields(item, value) for item, value in zip(live, rendered)] + live[len(rendered):]
+    return live
 
-def protect_service(app_svc):
-    load_kube_config(app_svc)
-    create_proxy_config(app_svc)
-    create_proxy_secrets(app_svc)
-    create_proxy_deployment(app_svc)
-    rsp = create_proxy_svc(app_svc)
-    update_svc(app_svc, rsp)
+
+def drop_empty(value):
+    # None, {} and [] are left out by kube (and the templates), they are
+    # not a difference
+    if isinstance(value, dict):
+        value = {key: drop_empty(val) for key, val in value.items()}
+        return {key: val for key, val in value.items() if val not in (None, {}, [])}
+    if isinstance(value, list):
+        return [drop_empty(item) for item in value]
+    return value
+
+
+def read_live(app_svc, manifest):
+    try:
+        obj = kind_api(app_svc, manifest['kind'], 'read')(
+            name=manifest['name'], namespace=app_svc.namespace)
+    except client.rest.ApiException as e:
+        if e.status == 404:
+            return None
+        raise(e)
+    return kube_clients.get_api_client(app_svc.kube_profile).sanitize_for_serialization(obj)
+
+
+def dry_run(app_svc):
+    """
+    Render the manifests of the proxy of the app svc and diff them against
+    the live objects, nothing is applied. The action of a manifest is
+    create, update, unchanged or delete (the hpa is removed)
+    """
+    rsp = []
+    for manifest in proxy_manifests(app_svc):
+        live = read_live(app_svc, manifest)
+        body = drop_empty(redact(manifest['body']))
+        if body is None and live is None:
+            continue
+        if live is not None:
+            live = drop_empty(redact(live_fields(live, body) if body is not None else live))
+        if body is None:
+            action = 'delete'
+        elif live is None:
+            action = 'create'
+        elif live == body:
+            action = 'unchanged'
+        else:
+            action = 'update'
+        diff = difflib.unified_diff(
+            yaml.safe_dump(live, default_flow_style=False).splitlines() if live else [],
+            yaml.safe_dump(body, default_flow_style=False).splitlines() if body else [],
+            "live/%s/%s" % (manifest['kind'], manifest['name']),
+            "rendered/%s/%s" % (manifest['kind'], manifest['name']), lineterm='')
+        rsp.append({
+            'kind': manifest['kind'],
+            'name': manifest['name'],
+            'action': action,
+            'applied': app_svc.proxy_hashes.get(manifest['kind']) == manifest['hash'],
+            'manifest': body,
+            'diff': '\n'.join(diff),
+        })
+    return rsp
 
 
 def delete_protection(app_svc):
-    load_kube_config(app_svc)
+    owner = lock_owner()
+    if lock_service(app_svc, owner) is None:
+        # deleted by another process
+        return
+    try:
+        delete_proxy(app_svc)
+    finally:
+        unlock_service(app_svc, owner)
+
+
+def delete_proxy(app_svc):
     name = "proxy-" + app_svc.name
     namespace = app_svc.namespace
-    v1 = client.CoreV1Api()
-    v1.delete_namespaced_service(name=name, namespace=namespace)
-    v1 = client.AppsV1Api()
-    v1.delete_namespaced_deployment(name=name, namespace=namespace)
+    v1 = kube_clients.core_api(app_svc.kube_profile)
+    # the proxy may not have been created or may be deleted already
+    delete_ignore_missing(v1.delete_namespaced_service, name, namespace)
+    delete_ignore_missing(v1.delete_namespaced_config_map, name + '-upstreams', namespace)
+    v1 = kube_clients.apps_api(app_svc.kube_profile)
+    delete_ignore_missing(v1.delete_namespaced_deployment, name, namespace)
+    if 'hpa' in app_svc.proxy_hashes:
+        v1 = kube_clients.autoscaling_api(app_svc.kube_profile)
+        delete_ignore_missing(v1.delete_namespaced_horizontal_pod_autoscaler, name, namespace)
+    app_svc.proxy_hashes = {}
+    prev_bundle = app_svc.proxy_rules_bundle
+    app_svc.proxy_rules_bundle = ""
     update_svc(app_svc, None)
+    if prev_bundle:
+        gc_shared_bundles(app_svc.kube_profile, app_svc.namespace)
 
-
-if __name__ == "__main__":
-    # svc must not have been deployed or date_modified is greater than date_deployed
-    query = {
-        "$or": [
-            {"$expr": {"$gt": ["$date_modified", "$proxy_date_deployed"]}},
-            {"proxy_date_deployed": ""}
-        ]
-    }
-    for svc in models.Service.objects(__raw__=query):
-        protect_service(svc)
\ No newline at end of file
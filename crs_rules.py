@@ -0,0 +1,338 @@
+"""
+Parser for the ModSecurity CRS rule files (SecRule/SecAction/SecMarker).
+
+A parsed rule is a dict with the directive, variables, operator, actions,
+id, the chained rules and the paranoia level of the section it is in. The
+paranoia level of a rule comes from the CRS skip markers in the file:
+
+    SecRule TX:EXECUTING_PARANOIA_LEVEL "@lt 2" "...,skipAfter:END-..."
+
+the rules following such a marker run only at paranoia level 2 or above.
+The markers themselves are returned with paranoia_marker set. Rules that
+are not in a paranoia section (initialization, blocking evaluation) have
+level 0 and always run.
+
+prune drops the rules above a paranoia level and the excluded rule ids,
+render writes the remaining rules back with their original source. The
+rendering of the rule files can be checked with:
+
+    python crs_rules.py [<rule file>..]
+"""
+import os
+import re
+import sys
+import threading
+
+PARANOIA_VARIABLE = 'TX:EXECUTING_PARANOIA_LEVEL'
+DATA_FILE_OPERATORS = ('@pmFromFile', '@pmf', '@ipMatchFromFile', '@ipMatchF')
+RULE_DIRECTIVES = ('SecRule', 'SecAction')
+
+# path -> (size, mtime, parsed rules)
+_parsed = {}
+_lock = threading.Lock()
+
+
+def logical_lines(text):
+    """
+    Yield (first line number, last line number, line) of the directives,
+    joining the lines continued with a trailing backslash and skipping
+    comments
+    """
+    current = []
+    start = 0
+    for lineno, line in enumerate(text.splitlines(), 1):
+        stripped = line.strip()
+        if not current and (not stripped or stripped.startswith('#')):
+            continue
+        if not current:
+            start = lineno
+        if stripped.endswith('\\'):
+            current.append(stripped[:-1])
+            continue
+        current.append(stripped)
+        yield start, lineno, ' '.join(current)
+        current = []
+    if current:
+        yield start, lineno, ' '.join(current)
+
+
+def split_tokens(line):
+    """
+    Split a directive into its arguments. Arguments are separated by white
+    space, double quoted arguments keep their spaces and \\" is a quote
+    """
+    tokens = []
+    token = []
+    in_quotes = False
+    quoted = False
+    idx = 0
+    while idx < len(line):
+        char = line[idx]
+        if in_quotes:
+            if char == '\\' and idx + 1 < len(line) and line[idx + 1] == '"':
+                token.append('"')
+                idx += 1
+            elif char == '"':
+                in_quotes = False
+            else:
+                token.append(char)
+        elif char == '"':
+            in_quotes = True
+            quoted = True
+        elif char.isspace():
+            if token or quoted:
+                tokens.append(''.join(token))
+            token = []
+            quoted = False
+        else:
+            token.append(char)
+        idx += 1
+    if token or quoted:
+        tokens.append(''.join(token))
+    return tokens
+
+
+def parse_actions(text):
+    """
+    List of (name, value) of the comma separated actions, values can be
+    single quoted
+    """
+    actions = []
+    idx = 0
+    while idx < len(text):
+        while idx < len(text) and (text[idx].isspace() or text[idx] == ','):
+            idx += 1
+        if idx >= len(text):
+            break
+        match = re.match(r"[\w-]+", text[idx:])
+        if not match:
+            idx += 1
+            continue
+        name = match.group(0)
+        idx += len(name)
+        value = None
+        if idx < len(text) and text[idx] == ':':
+            idx += 1
+            if idx < len(text) and text[idx] == "'":
+                end = idx + 1
+                while end < len(text) and not (text[end] == "'" and text[end - 1] != '\\'):
+                    end += 1
+                value = text[idx + 1:end]
+                idx = end + 1
+            else:
+                end = text.find(',', idx)
+                if end < 0:
+                    end = len(text)
+                value = text[idx:end].strip()
+                idx = end
+        actions.append((name, value))
+    return actions
+
+
+def action_values(rule, name):
+    return [value for key, value in rule['actions'] if key == name]
+
+
+def operator_data_file(operator):
+    """
+    Name of the .data file used by the operator, None if it uses none
+    """
+    op = operator.lstrip('!')
+    for data_op in DATA_FILE_OPERATORS:
+        if op.startswith(data_op + ' '):
+            return op[len(data_op):].strip()
+    return None
+
+
+def parse_file(fname, text):
+    """
+    List of the top level rules in the file text. The other directives
+    (SecMarker, SecComponentSignature..) are in the list too
+    """
+    rules = []
+    paranoia_level = 0
+    section_marker = None
+    parent = None
+    text_lines = text.splitlines()
+    for lineno, end, line in logical_lines(text):
+        tokens = split_tokens(line)
+        if not tokens:
+            continue
+        directive = tokens[0]
+        rule = {
+            'file': fname,
+            'line': lineno,
+            'source': '\n'.join(text_lines[lineno - 1:end]),
+            'directive': directive,
+            'variables': '',
+            'operator': '',
+            'actions': [],
+            'id': None,
+            'chain': [],
+            'paranoia_level': paranoia_level,
+            'paranoia_marker': False,
+            'section_level': 0,
+            'data_files': [],
+        }
+        if directive == 'SecRule' and len(tokens) >= 3:
+            rule['variables'] = tokens[1]
+            rule['operator'] = tokens[2]
+            if len(tokens) > 3:
+                rule['actions'] = parse_actions(tokens[3])
+        elif directive == 'SecAction' and len(tokens) >= 2:
+            rule['actions'] = parse_actions(tokens[1])
+        else:
+            if directive == 'SecMarker' and len(tokens) >= 2:
+                rule['marker'] = tokens[1]
+                if tokens[1] == section_marker:
+                    paranoia_level = 0
+                    section_marker = None
+                    rule['paranoia_level'] = 0
+            rules.append(rule)
+            parent = None
+            continue
+        ids = action_values(rule, 'id')
+        if ids:
+            rule['id'] = int(ids[0])
+        data_file = operator_data_file(rule['operator'])
+        if data_file:
+            rule['data_files'].append(data_file)
+        if parent is not None:
+            # chained rule, belongs to the rule that started the chain
+            parent['chain'].append(rule)
+            parent['data_files'].extend(rule['data_files'])
+            if not any(key == 'chain' for key, _ in rule['actions']):
+                parent = None
+            continue
+        match = re.match(r'@lt\s+(\d+)$', rule['operator'])
+        if rule['variables'] == PARANOIA_VARIABLE and match and action_values(rule, 'skipAfter'):
+            rule['paranoia_marker'] = True
+            rule['section_level'] = paranoia_level = int(match.group(1))
+            section_marker = action_values(rule, 'skipAfter')[0]
+            rule['paranoia_level'] = 0
+        rules.append(rule)
+        if any(key == 'chain' for key, _ in rule['actions']):
+            parent = rule
+    return rules
+
+
+def parse_setup(text):
+    """
+    tx variables set with setvar:tx.<name>=<value> in a setup file
+    (crs-setup.conf), the names are lower case
+    """
+    tx = {}
+    for _, _, line in logical_lines(text):
+        tokens = split_tokens(line)
+        if not tokens or tokens[0] not in ('SecAction', 'SecRule'):
+            continue
+        for key, value in parse_actions(tokens[-1]):
+            if key != 'setvar' or not value:
+                continue
+            match = re.match(r'tx\.([\w.-]+)=([^+-].*|)$', value, re.IGNORECASE)
+            if match and '%{' not in match.group(2):
+                tx.setdefault(match.group(1).lower(), match.group(2))
+    return tx
+
+
+def paranoia_level(crs_setup_text):
+    return int(parse_setup(crs_setup_text).get('paranoia_level', 1))
+
+
+def parse_path(path):
+    """
+    parse_file of the file at path, the parsed rules are cached until the
+    file changes. The returned rules must not be modified
+    """
+    stat = os.stat(path)
+    with _lock:
+        entry = _parsed.get(path)
+        if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+    with open(path, encoding='utf-8', errors='replace') as fd:
+        rules = parse_file(os.path.basename(path), fd.read())
+    with _lock:
+        _parsed[path] = (stat.st_size, stat.st_mtime_ns, rules)
+    return rules
+
+
+def prune(rules, paranoia_level, excluded_ids=()):
+    """
+    The rules that run at the paranoia level, without the excluded ids.
+    The skip markers of the removed paranoia sections are removed too
+    """
+    excluded_ids = set(excluded_ids)
+    kept = []
+    for rule in rules:
+        if rule['id'] is not None and rule['id'] in excluded_ids:
+            continue
+        if rule['paranoia_level'] > paranoia_level or rule['section_level'] > paranoia_level:
+            continue
+        kept.append(rule)
+    return kept
+
+
+def render(rules):
+    # a chained rule is followed by the rules of its chain
+    return '\n\n'.join('\n'.join([rule['source']] + [item['source'] for item in rule['chain']])
+                       for rule in rules) + '\n'
+
+
+def data_files(rules):
+    return set(fname for rule in rules for fname in rule['data_files'])
+
+
+def directives(rules):
+    """
+    (directive, id) of the rules and of their chained rules, in order
+    """
+    return [(item['directive'], item['id']) for rule in rules for item in [rule] + rule['chain']]
+
+
+def duplicate_ids(rule_lists):
+    """
+    Sorted ids that are defined more than once in the rule lists, the
+    chained rules included. ModSecurity does not load rules with the same id
+    """
+    seen = set()
+    duplicates = set()
+    for rules in rule_lists:
+        for _, rule_id in directives(rules):
+            if rule_id is None:
+                continue
+            if rule_id in seen:
+                duplicates.add(rule_id)
+            seen.add(rule_id)
+    return sorted(duplicates)
+
+
+def check_round_trip(path):
+    """
+    Check that rendering the rules of the file kept at the highest
+    paranoia level (4) gives back all the directives of the file, return
+    the error message or None
+    """
+    with open(path, encoding='utf-8', errors='replace') as fd:
+        text = fd.read()
+    fname = os.path.basename(path)
+    rules = parse_file(fname, text)
+    expected = directives(rules)
+    found = directives(parse_file(fname, render(prune(rules, 4))))
+    if found != expected:
+        return "%s: %d directives rendered, %d in the file" % (fname, len(found), len(expected))
+    return None
+
+
+def main():
+    paths = sys.argv[1:] or sorted(os.path.join('modsec', 'rules', fname)
+                                   for fname in os.listdir(os.path.join('modsec', 'rules'))
+                                   if fname.endswith('.conf'))
+    errors = [error for error in map(check_round_trip, paths) if error]
+    for error in errors:
+        print(error)
+    print("%d files checked, %d failed" % (len(paths), len(errors)))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
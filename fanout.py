@@ -0,0 +1,169 @@
+"""
+Fan out of the profile changes to the proxies rendered from them.
+
+The dependencies come from the models: references (field -> model of the
+referenced document name) and counted_in (a rule is part of its profile).
+eg. an address is referenced by the policy rules that are part of a
+policy profile that is referenced by the services. The TLS profiles and
+certificates are not fanned out, TLS is not rendered in the proxies yet.
+
+A change marks the affected services proxy_pending and re-renders them in
+a pool of threads, the progress is kept in a Rollout document. The
+services left pending (eg. the api exited in the middle of a rollout) are
+re-rendered by running this module:
+
+    python fanout.py [<model> <name>..]
+"""
+import concurrent.futures
+import datetime
+import logging
+import os
+import sys
+import threading
+
+from mongoengine import connect
+
+import base_query
+import create_proxy_svc
+import models
+
+DB_HOST = os.getenv('MONGODB_HOST', 'mongodb://localhost/sbf')
+WORKERS = int(os.getenv('SBF_FANOUT_WORKERS', 8))
+# rollout progress is logged every PROGRESS_EVERY services
+PROGRESS_EVERY = 25
+
+DEPENDENT_MODELS = [models.Service, models.PolicyProfileRule, models.WafProfileRuleSet]
+
+log = logging.getLogger(__name__)
+
+
+def affected_services(model_name, names):
+    """
+    ids of the services that depend on the documents of model_name with
+    the names
+    """
+    names = [name for name in set(names) if name]
+    if not names:
+        return set()
+    ids = set()
+    for dep_cls in DEPENDENT_MODELS:
+        for field, ref_model in dep_cls.references.items():
+            if ref_model != model_name:
+                continue
+            query = dep_cls.objects(**{field + '__in': names})
+            if dep_cls is models.Service:
+                ids.update(doc['_id'] for doc in query.only('id').as_pymongo())
+                continue
+            # the dependent documents are part of a profile (counted_in)
+            # or are a profile themselves
+            parent_model, parent_field = getattr(dep_cls, 'counted_in', (dep_cls.__name__, 'name'))[:2]
+            ids.update(affected_services(parent_model, query.distinct(parent_field)))
+    return ids
+
+
+def mark_pending(service_ids):
+    if service_ids:
+        models.Service.objects(id__in=list(service_ids)).update(set__proxy_pending=True)
+        base_query.bump_version(models.Service)
+
+
+def render_service(service_id):
+    """
+    Re-render the proxy of the service, return the service name and the
+    error message if it failed. protect_service locks the service, it is
+    rendered by one rollout (or watcher, job) at a time
+    """
+    # cleared first so that a change during the render marks it again
+    models.Service.objects(id=service_id).update_one(set__proxy_pending=False)
+    base_query.bump_version(models.Service)
+    app_svc = models.Service.objects(id=service_id).first()
+    if app_svc is None or app_svc.deleted:
+        return None, None
+    try:
+        create_proxy_svc.protect_service(app_svc)
+    except Exception as e:
+        log.exception("failed to render the proxy of %s", app_svc.name)
+        models.Service.objects(id=service_id).update_one(set__proxy_pending=True)
+        base_query.bump_version(models.Service)
+        return app_svc.name, str(e)
+    return app_svc.name, None
+
+
+def new_rollout(trigger, total):
+    now = datetime.datetime.utcnow()
+    rollout = models.Rollout(trigger=trigger, total=total, date_added=now, date_modified=now)
+    rollout.search_tokens = base_query.search_tokens(models.Rollout, {'trigger': trigger,
+                                                                      'status': 'running'})
+    rollout.save()
+    base_query.bump_version(models.Rollout)
+    return rollout
+
+
+def run_rollout(rollout, service_ids):
+    """
+    Render the services in parallel and record the progress in rollout
+    """
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        futures = [pool.submit(render_service, service_id) for service_id in service_ids]
+        for future in concurrent.futures.as_completed(futures):
+            name, error = future.result()
+            update = {'inc__done': 1, 'set__date_modified': datetime.datetime.utcnow()}
+            if error is not None:
+                update['inc__failed'] = 1
+                update['push__errors'] = {'service': name, 'error': error}
+            models.Rollout.objects(id=rollout.id).update_one(**update)
+            base_query.bump_version(models.Rollout)
+            done += 1
+            if done % PROGRESS_EVERY == 0 or done == len(service_ids):
+                log.info("rollout %s (%s): %d/%d", rollout.id, rollout.trigger, done, len(service_ids))
+    rollout.reload()
+    rollout.status = 'failed' if rollout.failed else 'done'
+    rollout.search_tokens = base_query.search_tokens(models.Rollout, {'trigger': rollout.trigger,
+                                                                      'status': rollout.status})
+    rollout.save()
+    base_query.bump_version(models.Rollout)
+    return rollout
+
+
+def changed(model_cls, names, wait=False):
+    """
+    Re-render the proxies of the services affected by the change of the
+    documents of model_cls with the names. The rollout runs in a thread
+    unless wait is set, return its id or None if no service is affected
+    """
+    names = [name for name in names if name]
+    service_ids = affected_services(model_cls.__name__, names)
+    if not service_ids:
+        return None
+    mark_pending(service_ids)
+    trigger = "%s %s" % (model_cls.__name__, ",".join(sorted(names)))
+    rollout = new_rollout(trigger, len(service_ids))
+    if wait:
+        run_rollout(rollout, list(service_ids))
+    else:
+        threading.Thread(target=run_rollout, args=(rollout, list(service_ids)), daemon=True).start()
+    return str(rollout.id)
+
+
+def run_pending():
+    """
+    Re-render the services left pending
+    """
+    service_ids = [doc['_id'] for doc in
+                   models.Service.objects(proxy_pending=True).only('id').as_pymongo()]
+    if not service_ids:
+        return None
+    return run_rollout(new_rollout("pending", len(service_ids)), service_ids)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    connect(host=DB_HOST)
+    if len(sys.argv) > 2:
+        changed(getattr(models, sys.argv[1]), sys.argv[2:], wait=True)
+    run_pending()
+
+
+if __name__ == "__main__":
+    main()
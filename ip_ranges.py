@@ -0,0 +1,87 @@
+"""
+ip networks as numeric ranges that can be compared in mongo.
+
+IPv4 addresses are mapped into the IPv6 space (::ffff:a.b.c.d) and all
+the addresses are stored as 32 char hex strings, so the string order is
+the address order for both versions
+"""
+import ipaddress
+import re
+
+from mongoengine.errors import ValidationError
+
+
+def parse_networks(value):
+    """
+    ip networks in value, a list of ip/cidr separated by comma or space
+    """
+    networks = []
+    for part in re.split(r'[,\s]+', value.strip()):
+        if part:
+            networks.append(ipaddress.ip_network(part, strict=False))
+    return networks
+
+
+def to_hex(address):
+    if address.version == 4:
+        address = ipaddress.IPv6Address('::ffff:' + str(address))
+    return '%032x' % int(address)
+
+
+def network_range(network):
+    return {
+        'start': to_hex(network.network_address),
+        'end': to_hex(network.broadcast_address),
+    }
+
+
+def prepare_address(data):
+    """
+    Validate the Address value and set its ranges
+    """
+    if 'value' not in data:
+        return
+    try:
+        networks = parse_networks(data['value'])
+    except ValueError as e:
+        raise ValidationError("invalid address value %s: %s" % (data['value'], e))
+    if not networks:
+        raise ValidationError("address value is empty")
+    data['ranges'] = [network_range(network) for network in networks]
+
+
+def contains_query(ip):
+    """
+    Raw query for the documents with a range containing ip
+    """
+    value = to_hex(ipaddress.ip_address(ip))
+    return {'ranges': {'$elemMatch': {'start': {'$lte': value}, 'end': {'$gte': value}}}}
+
+
+def overlaps_query(cidr):
+    """
+    Raw query for the documents with a range overlapping cidr
+    """
+    rng = network_range(ipaddress.ip_network(cidr, strict=False))
+    return {'ranges': {'$elemMatch': {'start': {'$lte': rng['end']}, 'end': {'$gte': rng['start']}}}}
+
+
+# a policy rule source that is a literal ip/cidr list, not an Address name
+LITERAL_SOURCE = r'^[0-9A-Fa-f.:/,\s]+$'
+
+
+def literal_matches(value, ip=None, cidr=None):
+    """
+    Check if the literal ip/cidr list value contains ip or overlaps cidr,
+    False if value is not a valid list
+    """
+    try:
+        networks = parse_networks(value)
+    except ValueError:
+        return False
+    if ip is not None:
+        address = ipaddress.ip_address(ip)
+        return any(address in network for network in networks)
+    target = ipaddress.ip_network(cidr, strict=False)
+    return any(network.version == target.version and network.overlaps(target)
+               for network in networks)
@@ -0,0 +1,232 @@
+"""
+Persisted queue of the proxy work requested through the api.
+
+Jobs are Job documents keyed by the action and the service, a job
+requested while one for the same key is queued is collapsed into it and
+the jobs of a key never run concurrently (the unique queued_key and
+running_key). The jobs are run by the worker threads of:
+
+    python job_queue.py
+
+which also queues again the jobs lost by a worker that exited. Every api
+process runs SBF_API_JOB_WORKERS workers too (2 by default), started with
+the app, so the jobs are run when job_queue.py is not deployed
+"""
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+
+from kubernetes import client
+from mongoengine import connect
+from mongoengine.errors import NotUniqueError
+
+import base_query
+import create_proxy_svc
+import models
+
+DB_HOST = os.getenv('MONGODB_HOST', 'mongodb://localhost/sbf')
+WORKERS = int(os.getenv('SBF_JOB_WORKERS', 4))
+# seconds between the polls of the queue when idle
+POLL_INTERVAL = float(os.getenv('SBF_JOB_POLL_INTERVAL', 1))
+MAX_ATTEMPTS = int(os.getenv('SBF_JOB_MAX_ATTEMPTS', 3))
+# a job running longer is considered lost (the worker exited) and queued again
+JOB_TIMEOUT = int(os.getenv('SBF_JOB_TIMEOUT', 600))
+# seconds between the checks for lost jobs
+REQUEUE_INTERVAL = 60
+# workers started in the api process (rest.py), set it to 0 when the
+# jobs are left to python job_queue.py
+API_WORKERS = int(os.getenv('SBF_API_JOB_WORKERS', 2))
+BACKOFF = 5
+
+log = logging.getLogger(__name__)
+
+_wakeup = threading.Event()
+_pool_lock = threading.Lock()
+_threads = []
+
+
+def protect(job):
+    app_svc = models.Service.objects(id=job.service_id).first()
+    if app_svc is None or app_svc.deleted:
+        return
+    create_proxy_svc.protect_service(app_svc)
+
+
+# action -> handler(job)
+ACTIONS = {
+    'protect': protect,
+}
+
+
+def now():
+    return datetime.datetime.utcnow()
+
+
+def enqueue(action, app_svc):
+    """
+    Queue the action for the service, return the queued job. A queued job
+    of the same action and service is returned instead of a new one
+    """
+    key = "%s:%s" % (action, app_svc.id)
+    while True:
+        job = models.Job.objects(queued_key=key).modify(new=True, inc__requests=1)
+        if job is not None:
+            # collapsed
+            base_query.bump_version(models.Job)
+            return job
+        timestamp = now()
+        job = models.Job(key=key, action=action, service_id=str(app_svc.id),
+                         service=app_svc.name, queued_key=key, run_after=timestamp,
+                         date_added=timestamp, date_modified=timestamp)
+        job.search_tokens = base_query.search_tokens(models.Job, {
+            'key': key, 'action': action, 'service': app_svc.name, 'status': 'queued'})
+        try:
+            job.save()
+        except NotUniqueError:
+            # queued concurrently, collapse into it
+            continue
+        base_query.bump_version(models.Job)
+        _wakeup.set()
+        return job
+
+
+def claim(worker):
+    """
+    Mark the oldest runnable job running and return it, None if there is
+    none. A job whose key is running already is left queued
+    """
+    timestamp = now()
+    for job in models.Job.objects(status='queued', run_after__lte=timestamp).order_by(
+            'run_after', 'date_added').only('id', 'key').limit(20):
+        try:
+            claimed = models.Job.objects(id=job.id, status='queued').modify(
+                new=True, set__status='running', set__running_key=job.key,
+                unset__queued_key=True, set__date_started=timestamp,
+                set__worker=worker, inc__attempts=1, set__date_modified=timestamp)
+        except NotUniqueError:
+            # the service has a running job
+            continue
+        if claimed is not None:
+            base_query.bump_version(models.Job)
+            return claimed
+    return None
+
+
+def finish(job, error=None, retry=False):
+    timestamp = now()
+    update = {
+        'unset__running_key': True,
+        'set__date_modified': timestamp,
+        'set__error': error,
+    }
+    if retry:
+        # queued again, unless the service has a queued job that supersedes it
+        update.update({'set__status': 'queued', 'set__queued_key': job.key,
+                       'set__run_after': timestamp + datetime.timedelta(
+                           seconds=BACKOFF * 2 ** (job.attempts - 1))})
+        try:
+            models.Job.objects(id=job.id).update_one(**update)
+            base_query.bump_version(models.Job)
+            return
+        except NotUniqueError:
+            del update['set__queued_key']
+            del update['set__run_after']
+            error = "superseded by a newer job: %s" % error
+            update['set__error'] = error
+    update.update({
+        'set__status': 'failed' if error else 'done',
+        'set__date_finished': timestamp,
+        'set__wait_ms': int((job.date_started - job.date_added).total_seconds() * 1000),
+        'set__duration_ms': int((timestamp - job.date_started).total_seconds() * 1000),
+    })
+    models.Job.objects(id=job.id).update_one(**update)
+    base_query.bump_version(models.Job)
+
+
+def run_job(job):
+    handler = ACTIONS.get(job.action)
+    if handler is None:
+        finish(job, "unknown action %s" % job.action)
+        return
+    try:
+        handler(job)
+    except client.rest.ApiException as e:
+        log.warning("job %s (%s) failed: %s", job.id, job.key, e)
+        finish(job, str(e), retry=job.attempts < MAX_ATTEMPTS)
+        return
+    except Exception as e:
+        log.exception("job %s (%s) failed", job.id, job.key)
+        finish(job, str(e))
+        return
+    finish(job)
+
+
+def requeue_lost():
+    """
+    Queue again the jobs running for longer than JOB_TIMEOUT
+    """
+    limit = now() - datetime.timedelta(seconds=JOB_TIMEOUT)
+    for job in models.Job.objects(status='running', date_started__lt=limit):
+        log.warning("job %s (%s) was lost by %s", job.id, job.key, job.worker)
+        finish(job, "lost by %s" % job.worker, retry=job.attempts < MAX_ATTEMPTS)
+
+
+def requeue_loop():
+    while True:
+        time.sleep(REQUEUE_INTERVAL)
+        try:
+            requeue_lost()
+        except Exception:
+            log.exception("failed to requeue the lost jobs")
+
+
+def worker_loop(name):
+    while True:
+        try:
+            job = claim(name)
+        except Exception:
+            log.exception("failed to claim a job")
+            job = None
+        if job is None:
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        run_job(job)
+
+
+def start_workers(count=WORKERS):
+    """
+    Start the worker threads of the process and the periodic requeue of
+    the lost jobs, once
+    """
+    with _pool_lock:
+        if _threads:
+            return
+        try:
+            requeue_lost()
+        except Exception:
+            log.exception("failed to requeue the lost jobs")
+        prefix = "%s-%d" % (socket.gethostname(), os.getpid())
+        for idx in range(count):
+            thread = threading.Thread(target=worker_loop, args=("%s-%d" % (prefix, idx),),
+                                      name="job-worker-%d" % idx, daemon=True)
+            thread.start()
+            _threads.append(thread)
+        thread = threading.Thread(target=requeue_loop, name="job-requeue", daemon=True)
+        thread.start()
+        _threads.append(thread)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    connect(host=DB_HOST)
+    start_workers()
+    for thread in _threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Kubernetes api clients cached per KubeProfile.
+
+The clients are built from the profile's kube_config without touching the
+global kubernetes config, so the clients of different clusters can be used
+concurrently. A client is reused until the profile's kube_config changes
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from kubernetes import client, config
+
+import models
+
+# max connections kept open per cluster
+POOL_SIZE = int(os.getenv('SBF_KUBE_POOL_SIZE', 8))
+# seconds before a cached client is checked against the profile in db
+REVALIDATE = float(os.getenv('SBF_KUBE_CLIENT_REVALIDATE', 30))
+
+# profile name -> {'hash', 'date_modified', 'checked', 'api_client'}
+_clients = {}
+_lock = threading.Lock()
+
+
+def config_hash(kube_config):
+    return hashlib.sha256(kube_config.encode()).hexdigest()
+
+
+def new_api_client(kube_config):
+    configuration = client.Configuration()
+    tmp_fd, tmp_file_name = tempfile.mkstemp(text=True)
+    try:
+        with os.fdopen(tmp_fd, "w") as fd:
+            fd.write(kube_config)
+        config.load_kube_config(tmp_file_name, client_configuration=configuration)
+    finally:
+        os.remove(tmp_file_name)
+    configuration.connection_pool_maxsize = POOL_SIZE
+    return client.ApiClient(configuration)
+
+
+def get_api_client(profile_name):
+    """
+    Return the ApiClient for the kube profile
+    """
+    now = time.time()
+    with _lock:
+        entry = _clients.get(profile_name)
+        if entry and now - entry['checked'] < REVALIDATE:
+            return entry['api_client']
+    if entry:
+        # only the modified date is read to check if the profile changed
+        profile = models.KubeProfile.objects(name=profile_name).only('date_modified').first()
+        if profile and profile.date_modified == entry['date_modified']:
+            entry['checked'] = now
+            return entry['api_client']
+    profile = models.KubeProfile.objects(name=profile_name).get()
+    kube_hash = config_hash(profile.kube_config)
+    with _lock:
+        entry = _clients.get(profile_name)
+        if entry and entry['hash'] == kube_hash:
+            entry['date_modified'] = profile.date_modified
+            entry['checked'] = now
+            return entry['api_client']
+    api_client = new_api_client(profile.kube_config)
+    with _lock:
+        replaced = _clients.get(profile_name)
+        _clients[profile_name] = {
+            'hash': kube_hash,
+            'date_modified': profile.date_modified,
+            'checked': now,
+            'api_client': api_client,
+        }
+    if replaced and replaced['api_client'] is not api_client:
+        close(replaced['api_client'])
+    return api_client
+
+
+def close(api_client):
+    # free the connection pool and the thread pool of the client, a
+    # request in progress on it may fail
+    try:
+        api_client.close()
+    except Exception:
+        pass
+
+
+def invalidate(profile_name):
+    with _lock:
+        entry = _clients.pop(profile_name, None)
+    if entry:
+        close(entry['api_client'])
+
+
+def core_api(profile_name):
+    return client.CoreV1Api(get_api_client(profile_name))
+
+
+def apps_api(profile_name):
+    return client.AppsV1Api(get_api_client(profile_name))
+
+
+def autoscaling_api(profile_name):
+    return client.AutoscalingV1Api(get_api_client(profile_name))
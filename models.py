@@ -1,14 +1,33 @@
-from mongoengine import Document, StringField, IntField, MapField, DateTimeField, ListField, DictField, BooleanField
+from mongoengine import Document, StringField, IntField, MapField, DateTimeField, ListField, DictField, BooleanField, FloatField
+
+import ip_ranges
+
+# kube resource quantity (eg. 500m, 0.5, 256Mi, 1G), empty when not set
+QUANTITY_REGEX = r'^(|([0-9]+(\.[0-9]*)?|\.[0-9]+)([numkMGTPE]|[KMGTPE]i|[eE][-+]?[0-9]+)?)$'
+
+
+def validate_fields(model_cls, data):
+    """
+    Validate the values of the model fields in data, the updates do not
+    run the validation of the fields
+    """
+    for key, value in data.items():
+        field = model_cls._fields.get(key)
+        if field is not None and value is not None:
+            field.validate(value)
 
 
 class BaseDocument(Document):
     date_added = DateTimeField()
     date_modified = DateTimeField()
+    # no longer written, replaced by search_tokens
     search = StringField()
-    # enable text search on 'search' field
+    # lower case tokens of the search_fields, see base_query.search_tokens
+    search_tokens = ListField(StringField())
+    search_fields = []
     meta = {
         'indexes': [
-            "$search"
+            'search_tokens'
         ],
         'abstract': True
     }
@@ -26,19 +45,58 @@ class Service(BaseDocument):
     ports = ListField()
     labels = ListField()
     creation_timestamp = DateTimeField()
+    # of the kube service last written, and the hash of its values the
+    # proxy is rendered from (update_kube_services)
+    resource_version = StringField()
+    spec_hash = StringField()
     proxy_port = IntField() # in nodeport deployment this is replaced with host port
     proxy_ip = ListField() # filled in later when the proxy svc is deployed (lbname or nodeport)
     proxy_svc_name = StringField()
     proxy_tls_profile = StringField()
     proxy_waf_profile = StringField()
     proxy_policy_profile = StringField()
+    # cluster_ip: proxy to the svc cluster ip, endpoints: to the ready pods
+    # directly, kept up to date by watching the endpoints and reloaded in
+    # the proxy pods without a restart (not with ip_hash)
+    proxy_upstream_mode = StringField(choices=['cluster_ip', 'endpoints'], default='cluster_ip')
+    proxy_lb_method = StringField(choices=['round_robin', 'least_conn', 'ip_hash'], default='round_robin')
+    proxy_performance_profile = StringField()
+    # hash of the last applied proxy objects (config, upstreams, secret, deployment, service)
+    proxy_hashes = DictField()
+    # shared rules bundle secret used in the shared bundle mode
+    proxy_rules_bundle = StringField()
+    # a profile the proxy depends on changed and it is not re-rendered yet
+    proxy_pending = BooleanField(default=False)
+    # last time all the proxy objects were applied regardless of their hash
+    proxy_date_applied = DateTimeField()
+    # the render holding the proxy of the service and until when
+    # (create_proxy_svc.lock_service)
+    proxy_lock = StringField()
+    proxy_lock_until = DateTimeField()
     deleted = BooleanField(default=False)
+    exclude_fields = ['proxy_hashes', 'proxy_lock', 'proxy_lock_until']
+    # only the kube service values so that the watcher can write the tokens
+    search_fields = ['name', 'namespace', 'cluster_ip', 'ports', 'labels', 'kube_profile']
+    # field -> model of the profiles the proxy is rendered from (fanout).
+    # proxy_tls_profile is not rendered yet
+    references = {
+        'proxy_waf_profile': 'WafProfile',
+        'proxy_policy_profile': 'PolicyProfile',
+        'proxy_performance_profile': 'PerformanceProfile',
+    }
     meta = {
         'indexes': [
             {
                 'fields': ['uid'],
                 'unique': True
-            }
+            },
+            ('kube_profile', 'namespace'),
+            'proxy_waf_profile',
+            'proxy_tls_profile',
+            'proxy_policy_profile',
+            'proxy_performance_profile',
+            'proxy_pending',
+            ('kube_profile', 'proxy_date_applied'),
         ]
     }
 
@@ -46,7 +104,8 @@ class Service(BaseDocument):
 class PolicyProfile(BaseDocument):
     name = StringField()
     services = ListField(StringField())
-    rule_count = IntField()
+    rule_count = IntField(default=0)
+    search_fields = ['name', 'services']
 
 
 class PolicyProfileRule(BaseDocument):
@@ -55,12 +114,22 @@ class PolicyProfileRule(BaseDocument):
     source = StringField(default="any")
     action = StringField(choices=['allow', 'drop'])
     log = StringField(choices=['log', 'nolog'])
+    search_fields = ['name', 'profile_name', 'source', 'action']
+    # PolicyProfile.rule_count is kept up to date by base_query
+    counted_in = ('PolicyProfile', 'profile_name', 'rule_count')
+    references = {'source': 'Address'}
+    meta = {
+        'indexes': [
+            'source'
+        ]
+    }
 
 
 class WafRuleSet(BaseDocument):
     # add ruleset names here (eg. REQUEST-911-PROTOCOL)
     name = StringField(required=True)
     version = StringField()
+    search_fields = ['name', 'version']
     meta = {
         'indexes': [
             'version',
@@ -76,6 +145,18 @@ class WafProfile(BaseDocument):
     name = StringField(required=True)
     rule_set_version = StringField()
     rule_count = IntField(default=0)
+    # the bundle has the rules up to the paranoia level (crs-setup.conf
+    # level if not set) without the excluded rule ids
+    paranoia_level = IntField(min_value=1, max_value=4)
+    excluded_rule_ids = ListField(IntField())
+    inbound_anomaly_threshold = IntField()
+    outbound_anomaly_threshold = IntField()
+    # last results of waf_bench and the p50 latency it added per request
+    benchmark = DictField()
+    estimated_overhead_ms = FloatField()
+    # the benchmark is large, see /waf-profile/<name>/benchmark
+    exclude_fields = ['benchmark']
+    search_fields = ['name', 'rule_set_version']
     meta = {
         'indexes': [
             {
@@ -89,6 +170,10 @@ class WafProfile(BaseDocument):
 class WafProfileRuleSet(BaseDocument):
     profile_name = StringField()
     rule_set_name = StringField()
+    search_fields = ['profile_name', 'rule_set_name']
+    # WafProfile.rule_count is kept up to date by base_query
+    counted_in = ('WafProfile', 'profile_name', 'rule_count')
+    references = {'rule_set_name': 'WafRuleSet'}
     meta = {
         'indexes': [
             {
@@ -102,6 +187,42 @@ class WafProfileRuleSet(BaseDocument):
 class TlsProfile(BaseDocument):
     name = StringField(required=True)
     certificate = StringField()
+    search_fields = ['name', 'certificate']
+    references = {'certificate': 'Certificate'}
+    meta = {
+        'indexes': [
+            {
+                'fields': ['name'],
+                'unique': True
+            },
+            'certificate'
+        ]
+    }
+
+
+class PerformanceProfile(BaseDocument):
+    """
+    Sizing of the proxy nginx and pods
+    """
+    name = StringField(required=True)
+    worker_connections = IntField(default=1024, min_value=1)
+    keepalive_timeout = IntField(default=65)
+    # idle connections kept open to the upstream per nginx worker
+    upstream_keepalive = IntField(default=32, min_value=1)
+    proxy_buffering = BooleanField(default=False)
+    gzip = BooleanField(default=False)
+    replicas = IntField(default=2)
+    # kube quantities eg. 500m, 256Mi, not set if empty
+    cpu_request = StringField(default="", regex=QUANTITY_REGEX)
+    cpu_limit = StringField(default="", regex=QUANTITY_REGEX)
+    memory_request = StringField(default="", regex=QUANTITY_REGEX)
+    memory_limit = StringField(default="", regex=QUANTITY_REGEX)
+    # horizontal pod autoscaler is created when hpa_max_replicas is set
+    hpa_min_replicas = IntField(default=1)
+    hpa_max_replicas = IntField(default=0)
+    hpa_cpu_target = IntField(default=80)
+    search_fields = ['name']
+    prepare_data = classmethod(validate_fields)
     meta = {
         'indexes': [
             {
@@ -119,6 +240,9 @@ class Certificate(BaseDocument):
     subjects = ListField(StringField())
     issue_date = DateTimeField()
     expiry_date = DateTimeField()
+    # not read from the db in the api responses
+    exclude_fields = ['body', 'private_key']
+    search_fields = ['name', 'subjects']
     meta = {
         'indexes': [
             {
@@ -133,12 +257,18 @@ class Address(BaseDocument):
     name = StringField(required=True)
     value = StringField(required=True)
     description = StringField()
+    # start/end of the networks in value (ip_ranges), set on write
+    ranges = ListField(DictField())
+    exclude_fields = ['ranges']
+    search_fields = ['name', 'value', 'description']
+    prepare_data = staticmethod(ip_ranges.prepare_address)
     meta = {
         'indexes': [
             {
                 'fields': ['name'],
                 'unique': True
-            }
+            },
+            ('ranges.start', 'ranges.end')
         ]
     }
 
@@ -147,6 +277,12 @@ class KubeProfile(BaseDocument):
     name = StringField(required=True)
     kube_config = StringField()
     cluster = StringField()
+    # services watch is resumed from here (update_kube_services)
+    watch_resource_version = StringField()
+    # events, processed, coalesced and coalescing_ratio of the watch
+    watch_stats = DictField()
+    exclude_fields = ['kube_config']
+    search_fields = ['name', 'cluster']
     meta = {
         'indexes': [
             {
@@ -155,3 +291,70 @@ class KubeProfile(BaseDocument):
             }
         ]
     }
+
+
+class Rollout(BaseDocument):
+    """
+    Re-render of the proxies affected by a change (fanout)
+    """
+    trigger = StringField()
+    status = StringField(choices=['running', 'done', 'failed'], default='running')
+    total = IntField(default=0)
+    done = IntField(default=0)
+    failed = IntField(default=0)
+    # {'service': name, 'error': message} of the failed proxies
+    errors = ListField(DictField())
+    search_fields = ['trigger', 'status']
+    meta = {
+        'indexes': [
+            'status'
+        ]
+    }
+
+
+class Job(BaseDocument):
+    """
+    Proxy work queued by the api (job_queue). A service has at most one
+    queued and one running job, queued_key and running_key are set to the
+    job key while the job is in that status
+    """
+    key = StringField(required=True)
+    action = StringField(required=True)
+    service_id = StringField()
+    service = StringField()
+    status = StringField(choices=['queued', 'running', 'done', 'failed'], default='queued')
+    queued_key = StringField()
+    running_key = StringField()
+    # number of requests collapsed into the job
+    requests = IntField(default=1)
+    attempts = IntField(default=0)
+    run_after = DateTimeField()
+    date_started = DateTimeField()
+    date_finished = DateTimeField()
+    # queued -> started and started -> finished
+    wait_ms = IntField()
+    duration_ms = IntField()
+    worker = StringField()
+    error = StringField()
+    search_fields = ['key', 'action', 'service']
+    meta = {
+        'indexes': [
+            {
+                'fields': ['queued_key'],
+                'unique': True,
+                'sparse': True
+            },
+            {
+                'fields': ['running_key'],
+                'unique': True,
+                'sparse': True
+            },
+            ('status', 'run_after', 'date_added'),
+            ('status', 'date_started'),
+            # finished jobs are kept for a week
+            {
+                'fields': ['date_finished'],
+                'expireAfterSeconds': 7 * 24 * 3600
+            }
+        ]
+    }
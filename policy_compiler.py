@@ -0,0 +1,155 @@
+"""
+Compile the rules of a PolicyProfile into an nginx geo map.
+
+The rules are first-match in their order (date added). The source of a
+rule is "any", an Address name or a literal ip/cidr. nginx geo picks the
+longest matching prefix, so the networks shadowed by earlier rules are
+left out to have the geo lookup give the same result as evaluating the
+rules in order (see first_match_entries). A rule whose source does not
+resolve fails the compile (PolicyError), the proxy is not rendered.
+"""
+import collections
+import hashlib
+import ipaddress
+import json
+import threading
+
+import ip_ranges
+import models
+
+CACHE_SIZE = 64
+
+# profile hash -> compiled conf
+_cache = collections.OrderedDict()
+_lock = threading.Lock()
+
+ANY_NETWORKS = ['0.0.0.0/0', '::/0']
+
+empty_policy = """
+geo $sbf_policy {
+    default allow;
+}
+geo $sbf_policy_log {
+    default 0;
+}
+"""
+
+
+class PolicyError(ValueError):
+    pass
+
+
+def load_rules(profile_name):
+    """
+    Rules of the profile in order with their source resolved to networks
+    """
+    rules = list(models.PolicyProfileRule.objects(profile_name=profile_name)
+                 .order_by('date_added', 'id').only('source', 'action', 'log').as_pymongo())
+    names = set(rule.get('source', 'any') for rule in rules)
+    addresses = {}
+    for address in models.Address.objects(name__in=list(names)).only('name', 'value').as_pymongo():
+        addresses[address['name']] = address['value']
+    resolved = []
+    for rule in rules:
+        source = rule.get('source', 'any')
+        if source == 'any':
+            value = ' '.join(ANY_NETWORKS)
+        else:
+            value = addresses.get(source, source)
+        resolved.append({
+            'source': source,
+            'value': value,
+            'action': rule.get('action') or 'allow',
+            'log': rule.get('log') == 'log',
+        })
+    return resolved
+
+
+def first_match_entries(rules):
+    """
+    Network -> (action, log) entries that give the first-match result of the
+    rules with a longest prefix lookup. A network inside (or equal to) a
+    network of an earlier rule never matches and is left out, the networks
+    of earlier rules inside it are more specific and win the lookup.
+    PolicyError is raised for a rule whose source does not resolve (eg. a
+    deleted Address)
+    """
+    seen = []
+    entries = {}
+    for rule in rules:
+        try:
+            networks = ip_ranges.parse_networks(rule['value'])
+        except ValueError as e:
+            # skipping a rule changes what the later rules match (a drop
+            # rule would fail open), the policy is not compiled
+            raise PolicyError("policy rule source %s is not an address or ip/cidr: %s"
+                              % (rule['source'], e))
+        for network in networks:
+            if any(network.version == prev.version and network.subnet_of(prev) for prev in seen):
+                continue
+            entries[network] = (rule['action'], rule['log'])
+        seen.extend(networks)
+    return entries
+
+
+def merge_entries(entries):
+    """
+    Collapse the adjacent and overlapping networks with the same value.
+    A merge is not done when a network with another value would become
+    more specific than one of the merged networks it contains
+    """
+    groups = collections.defaultdict(list)
+    for network, value in entries.items():
+        groups[value].append(network)
+    merged = {}
+    for value, networks in groups.items():
+        for version in (4, 6):
+            nets = [net for net in networks if net.version == version]
+            for snet in ipaddress.collapse_addresses(nets):
+                parts = [net for net in nets if net.subnet_of(snet)]
+                others = [net for net, val in entries.items()
+                          if val != value and net.version == version and net.subnet_of(snet)]
+                if any(part != snet and part.subnet_of(other) for other in others for part in parts):
+                    for part in parts:
+                        merged[part] = value
+                else:
+                    merged[snet] = value
+    return merged
+
+
+def compile_rules(rules):
+    """
+    Return the nginx conf for the resolved rules
+    """
+    entries = merge_entries(first_match_entries(rules))
+    policy = ["geo $sbf_policy {", "    default allow;"]
+    policy_log = ["geo $sbf_policy_log {", "    default 0;"]
+    for network in sorted(entries, key=lambda net: (net.version, net)):
+        action, log_flag = entries[network]
+        policy.append("    %s %s;" % (network, action))
+        policy_log.append("    %s %d;" % (network, 1 if log_flag else 0))
+    policy.append("}")
+    policy_log.append("}")
+    return "\n".join(policy + policy_log) + "\n"
+
+
+def compile_policy(profile_name):
+    """
+    nginx conf with the geo maps of the policy profile. The compiled conf
+    is cached by the hash of the resolved rules
+    """
+    if not profile_name:
+        return empty_policy
+    rules = load_rules(profile_name)
+    profile_hash = hashlib.sha256(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+    with _lock:
+        conf = _cache.get(profile_hash)
+        if conf is not None:
+            _cache.move_to_end(profile_hash)
+            return conf
+    conf = compile_rules(rules)
+    with _lock:
+        _cache[profile_hash] = conf
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return conf
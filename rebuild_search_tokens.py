@@ -0,0 +1,35 @@
+"""
+Compute the search_tokens of the documents written before search_tokens
+replaced the text index, ?search= does not find the documents without
+them. Run once after upgrading, --all recomputes the tokens of all the
+documents (eg. after the search_fields of a model changed):
+
+    python rebuild_search_tokens.py [--all]
+"""
+import os
+import sys
+
+from mongoengine import connect
+
+import base_query
+import models
+
+DB_HOST = os.getenv('MONGODB_HOST', 'mongodb://localhost/sbf')
+
+
+def searchable_models():
+    return [model_cls for model_cls in vars(models).values()
+            if isinstance(model_cls, type) and issubclass(model_cls, models.BaseDocument)
+            and model_cls is not models.BaseDocument and model_cls.search_fields]
+
+
+def main():
+    connect(host=DB_HOST)
+    missing_only = '--all' not in sys.argv[1:]
+    for model_cls in searchable_models():
+        updated = base_query.rebuild_search_tokens(model_cls, missing_only=missing_only)
+        print("%s: %d documents updated" % (model_cls.__name__, updated))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Work queue and worker pool to process the kube service events concurrently
+"""
+import heapq
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Reconciler:
+    """
+    Runs handler(*args) for the submitted work in a pool of worker threads.
+
+    Work is keyed (by the service uid), the work for the same key is never
+    run concurrently and the work submitted while the key is waiting or
+    running is coalesced, only the latest args are run. submit blocks when
+    queue_size keys are waiting, queued or held in a debounce window. The
+    handler is retried with exponential backoff on the retry_exceptions.
+
+    Work submitted with a delay is held for that debounce window, the
+    work submitted for the key in the window is coalesced into it. Work
+    submitted without a delay cancels the window and is queued right away.
+    The debounce windows and the retry backoffs are timed by one scheduler
+    thread.
+
+    on_done(key, args) is called after the handler is run for the args and
+    is not retried (it succeeded or failed for good)
+    """
+    def __init__(self, handler, workers=4, queue_size=100, retry_exceptions=(),
+                 max_retries=5, backoff=1.0, max_backoff=60.0, on_done=None):
+        self.handler = handler
+        self.on_done = on_done
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue()
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        # signalled when a waiting key is picked up by a worker
+        self.not_full = threading.Condition(self.lock)
+        # signalled when a delayed entry is scheduled
+        self.scheduled = threading.Condition(self.lock)
+        # number of submitted keys queued or in a debounce window
+        self.waiting = 0
+        # key -> args waiting to run
+        self.pending = {}
+        self.queued = set()
+        self.running = set()
+        # key -> number of submits, to drop the retries of stale work
+        self.generation = {}
+        # key -> retry attempt of the pending args
+        self.attempts = {}
+        # key -> seq of its debounce window entry in delayed
+        self.windows = {}
+        # heap of (due time, seq, key, retry) of the debounce windows
+        # (retry None) and the retries (args, generation, attempt)
+        self.delayed = []
+        self.seq = 0
+        self.stopped = False
+        self.stats = {'submitted': 0, 'coalesced': 0, 'processed': 0, 'retried': 0}
+        self.threads = []
+        for idx in range(workers):
+            thread = threading.Thread(target=self.worker, name="reconciler-%d" % idx,
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.scheduler_thread = threading.Thread(target=self.scheduler,
+                                                 name="reconciler-scheduler", daemon=True)
+        self.scheduler_thread.start()
+
+    def submit(self, key, *args, delay=0):
+        with self.lock:
+            self.stats['submitted'] += 1
+            if key in self.pending:
+                self.stats['coalesced'] += 1
+            self.generation[key] = self.generation.get(key, 0) + 1
+            self.pending[key] = args
+            self.attempts.pop(key, None)
+            while True:
+                if key in self.windows:
+                    if delay:
+                        # held in the debounce window
+                        return
+                    # queued right away with the slot of the window
+                    del self.windows[key]
+                    self.queued.add(key)
+                    self.queue.put((key, True))
+                    return
+                if key in self.queued or key in self.running:
+                    # coalesced, run with the latest args when picked up or
+                    # after the running one is done
+                    return
+                if self.waiting < self.queue_size:
+                    break
+                self.not_full.wait()
+            self.waiting += 1
+            if delay:
+                self.windows[key] = self.schedule(delay, key)
+                return
+            self.queued.add(key)
+            self.queue.put((key, True))
+
+    def schedule(self, delay, key, retry=None):
+        # called with the lock held, return the seq of the entry
+        self.seq += 1
+        heapq.heappush(self.delayed, (time.monotonic() + delay, self.seq, key, retry))
+        self.scheduled.notify()
+        return self.seq
+
+    def scheduler(self):
+        with self.lock:
+            while not self.stopped:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, seq, key, retry = heapq.heappop(self.delayed)
+                    if retry is None:
+                        self.release(key, seq)
+                    else:
+                        self.retry(key, *retry)
+                self.scheduled.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def release(self, key, seq):
+        # end of the debounce window, called with the lock held
+        if self.windows.get(key) != seq:
+            # cancelled
+            return
+        del self.windows[key]
+        if key not in self.pending or key in self.queued or key in self.running:
+            self.waiting -= 1
+            self.not_full.notify()
+            return
+        self.queued.add(key)
+        self.queue.put((key, True))
+
+    def coalescing_ratio(self):
+        """
+        Number of submitted work per handler run
+        """
+        with self.lock:
+            return self.stats['submitted'] / max(1, self.stats['processed'])
+
+    def enqueue(self, key):
+        # called with the lock held, the internal requeues do not wait for
+        # a slot as they come from the workers
+        self.queued.add(key)
+        self.queue.put((key, False))
+
+    def worker(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                self.queue.task_done()
+                return
+            key, holds_slot = entry
+            with self.lock:
+                if holds_slot:
+                    self.waiting -= 1
+                    self.not_full.notify()
+                self.queued.discard(key)
+                args = self.pending.pop(key, None)
+                attempt = self.attempts.pop(key, 0)
+                if args is not None:
+                    self.running.add(key)
+                generation = self.generation.get(key)
+            if args is not None:
+                self.run(key, args, generation, attempt)
+            self.queue.task_done()
+
+    def run(self, key, args, generation, attempt):
+        retry = False
+        with self.lock:
+            self.stats['processed'] += 1
+        try:
+            self.handler(*args)
+        except self.retry_exceptions as e:
+            retry = attempt < self.max_retries
+            if not retry:
+                log.error("giving up on %s after %d retries: %s", key, attempt, e)
+        except Exception:
+            log.exception("failed to process %s", key)
+        with self.lock:
+            self.running.discard(key)
+            if key in self.pending:
+                # newer work came in while running, that supersedes a retry
+                if key not in self.queued and key not in self.windows:
+                    self.enqueue(key)
+            elif not retry and self.generation.get(key) == generation:
+                del self.generation[key]
+            if retry:
+                self.stats['retried'] += 1
+                self.schedule(min(self.max_backoff, self.backoff * 2 ** attempt), key,
+                              (args, generation, attempt + 1))
+        if not retry and self.on_done:
+            self.on_done(key, args)
+
+    def retry(self, key, args, generation, attempt):
+        # called with the lock held
+        if self.generation.get(key) != generation:
+            # newer work was submitted for the key
+            return
+        self.pending[key] = args
+        self.attempts[key] = attempt
+        if key not in self.queued and key not in self.running and key not in self.windows:
+            self.enqueue(key)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.scheduled.notify()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads + [self.scheduler_thread]:
+            thread.join()
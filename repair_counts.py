@@ -0,0 +1,36 @@
+"""
+Verify and repair the counts kept by base_query (eg. WafProfile.rule_count)
+against the actual number of documents. Runs every SBF_REPAIR_INTERVAL
+seconds, or once if it is 0
+"""
+import os
+import time
+
+from mongoengine import connect
+
+import base_query
+import models
+
+DB_HOST = os.getenv('MONGODB_HOST', 'mongodb://localhost/sbf')
+INTERVAL = int(os.getenv('SBF_REPAIR_INTERVAL', 3600))
+
+COUNTED_MODELS = [models.PolicyProfileRule, models.WafProfileRuleSet]
+
+
+def repair():
+    for model_cls in COUNTED_MODELS:
+        for name, stored, actual in base_query.repair_counter(model_cls):
+            print("%s %s: count %d fixed to %d" % (model_cls.counted_in[0], name, stored, actual))
+
+
+def main():
+    connect(host=DB_HOST)
+    while True:
+        repair()
+        if INTERVAL <= 0:
+            break
+        time.sleep(INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
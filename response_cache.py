@@ -0,0 +1,70 @@
+"""
+Cache of the GET responses of the api, validated by the versions of the
+collections the response is built from (base_query.bump_version)
+"""
+import collections
+import functools
+import hashlib
+import os
+import threading
+import time
+
+from flask import request
+
+import base_query
+
+CACHE_SIZE = int(os.getenv('SBF_RESPONSE_CACHE_SIZE', 256))
+CACHE_TTL = float(os.getenv('SBF_RESPONSE_CACHE_TTL', 60))
+
+# etag -> (time cached, body)
+_cache = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def make_etag(model_classes):
+    versions = [str(base_query.get_version(model_cls)) for model_cls in model_classes]
+    key = request.full_path + '|' + ','.join(versions)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def lookup(etag):
+    with _lock:
+        entry = _cache.get(etag)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > CACHE_TTL:
+            del _cache[etag]
+            return None
+        _cache.move_to_end(etag)
+        return entry[1]
+
+
+def store(etag, body):
+    with _lock:
+        _cache[etag] = (time.time(), body)
+        _cache.move_to_end(etag)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def cached(*model_classes):
+    """
+    Decorate a Resource get method whose response depends only on the
+    request url and the documents of model_classes. The response gets an
+    ETag, a matching If-None-Match gets a 304 and the unchanged responses
+    are served from the cache without querying the collections
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            etag = make_etag(model_classes)
+            headers = {'ETag': '"%s"' % etag}
+            if request.if_none_match.contains(etag):
+                return None, 304, headers
+            body = lookup(etag)
+            if body is None:
+                body = func(*args, **kwargs)
+                store(etag, body)
+            return body, 200, headers
+        return wrapper
+    return decorator
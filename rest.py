@@ -1,26 +1,41 @@
+import json
 import os
-import tempfile
 import time
 
 import arrow
-from flask import Flask, abort, request
+from flask import Flask, Response, abort, request
 from flask_restplus import Api, Resource
-import kubernetes
 from mongoengine import connect
 import OpenSSL.crypto
+import yaml
 
 import base_query
 import create_proxy_svc
+import fanout
+import ip_ranges
+import job_queue
+import kube_clients
 import models
+import policy_compiler
+from response_cache import cached
 
 DB_HOST = os.getenv('MONGODB_HOST', 'mongodb://localhost/sbf')
 connect(host=DB_HOST, connect=False)
 
 app = Flask(__name__)
 api = Api(app)
+if job_queue.API_WORKERS:
+    job_queue.start_workers(job_queue.API_WORKERS)
+
+
+@api.errorhandler(base_query.QueryError)
+def query_error(e):
+    return {'message': str(e)}, 400
+
 
 @api.route('/services')
 class ServiceList(Resource):
+    @cached(models.Service)
     def get(self):
         return base_query.get_all_items(models.Service, **request.args)
 
@@ -28,7 +43,7 @@ class ServiceList(Resource):
 @api.route('/service/<string:name>')
 class Service(Resource):
     def get(self, name):
-        return base_query.get_item(models.Service, name=name)
+        return base_query.get_item(models.Service, fields=request.args.get('fields'), name=name)
 
     def put(self, name):
         data = request.json
@@ -36,29 +51,53 @@ class Service(Resource):
         im_fields = ['name', 'namespace', 'cluster_ip', 'ports', 'labels', 'creation_timestamp']
         for im_field in im_fields:
             del data[im_field]
+        # set by the watcher, none of the search fields is updated
+        for field in ['kube_profile', 'proxy_hashes', 'proxy_lock', 'proxy_lock_until']:
+            data.pop(field, None)
         rsp = base_query.update_item(models.Service, {'name': name}, **request.json)
-        create_proxy_svc.protect_service(rsp)
-        return rsp.to_json()
+        if rsp is None:
+            abort(404)
+        # the proxy is updated by the job workers, see /jobs/<id>
+        job = job_queue.enqueue('protect', rsp)
+        return {'job_id': str(job.id), 'status': job.status}, 202, {'Location': '/jobs/%s' % job.id}
+
+
+@api.route('/service/<string:name>/render')
+class ServiceRender(Resource):
+    def get(self, name):
+        # dry-run: the proxy manifests and their diff against the live
+        # objects, nothing is applied
+        app_svc = models.Service.objects(name=name).first()
+        if app_svc is None:
+            abort(404)
+        try:
+            return create_proxy_svc.dry_run(app_svc)
+        except policy_compiler.PolicyError as e:
+            abort(400, str(e))
 
 
 @api.route('/waf-rule-sets')
 class WafRuleSetList(Resource):
+    @cached(models.WafRuleSet)
     def get(self):
         return base_query.get_all_items(models.WafRuleSet, **request.args)
 
     def post(self):
-        for ruleset in request.json:
-            base_query.create_item(models.WafRuleSet, **ruleset)
+        rsp = base_query.bulk_create(models.WafRuleSet, request.json)
+        fanout.changed(models.WafRuleSet, [item.get('name') for item in request.json])
+        return rsp
 
 
 @api.route('/waf-rule-sets/versions')
 class WafRuleSetVersions(Resource):
+    @cached(models.WafRuleSet)
     def get(self):
         return base_query.distinct_items(models.WafRuleSet)
 
 
 @api.route('/waf-profiles')
 class WafProfileList(Resource):
+    @cached(models.WafProfile)
     def get(self):
         return base_query.get_all_items(models.WafProfile, **request.args)
 
@@ -69,41 +108,59 @@ class WafProfileList(Resource):
 @api.route('/waf-profile/<string:name>')
 class WafProfile(Resource):
     def get(self, name):
-        return base_query.get_item(models.WafProfile, name=name)
+        return base_query.get_item(models.WafProfile, fields=request.args.get('fields'), name=name)
 
     def put(self, name):
         data = request.json
         del data['name']
-        return base_query.update_item(models.WafProfile, {'name': name}, **data)        
+        rsp = base_query.update_item(models.WafProfile, {'name': name}, **data)
+        # the proxies using the profile get the new bundle
+        fanout.changed(models.WafProfile, [name])
+        return rsp
 
     def delete(self, name):
         base_query.delete_item(models.WafProfile, name=name)
         # delete all the profile rulesets for this profile
         base_query.delete_item(models.WafProfileRuleSet, profile_name=name)
+        fanout.changed(models.WafProfile, [name])
         return
 
 
+@api.route('/waf-profile/<string:name>/benchmark')
+class WafProfileBenchmark(Resource):
+    def get(self, name):
+        # last results of waf_bench.py, left out of the waf profile responses
+        rsp = base_query.get_item(models.WafProfile, fields='benchmark', exclude=[], name=name)
+        if rsp is None:
+            abort(404)
+        return rsp.get('benchmark', {})
+
+
 @api.route('/waf-profile-rule-sets/<string:profile_name>')
 class WafProfileRuleSetList(Resource):
+    @cached(models.WafProfileRuleSet)
     def get(self, profile_name):
         return base_query.get_all_items(models.WafProfileRuleSet, profile_name=profile_name, **request.args)
 
     def post(self, profile_name):
         rule_set_list = request.json['rule_set_list']
         replace = request.json.get('replace', False)
+        items = [{'profile_name': profile_name, 'rule_set_name': rule_set_name}
+                 for rule_set_name in rule_set_list]
         if replace:
             # delete existing rules on the profile
             base_query.delete_item(models.WafProfileRuleSet, profile_name=profile_name)
-        for rule_set_name in rule_set_list:
-            data = {'profile_name': profile_name, 'rule_set_name': rule_set_name}
-            base_query.create_item(models.WafProfileRuleSet, **data)
-        # update waf-profile with the number of rules
-        base_query.update_item(models.WafProfile, {'name': profile_name}, rule_count=len(rule_set_list))
-        return None
+            rsp = base_query.bulk_create(models.WafProfileRuleSet, items)
+        else:
+            rsp = base_query.bulk_upsert(models.WafProfileRuleSet, items,
+                ['profile_name', 'rule_set_name'])
+        fanout.changed(models.WafProfile, [profile_name])
+        return rsp
 
 
 @api.route('/tls-profiles')
 class TlsProfileList(Resource):
+    @cached(models.TlsProfile)
     def get(self):
         return base_query.get_all_items(models.TlsProfile, **request.args)
 
@@ -114,29 +171,51 @@ class TlsProfileList(Resource):
 @api.route('/tls-profile/<string:name>')
 class TlsProfile(Resource):
     def get(self, name):
-        return base_query.get_item(models.TlsProfile, name=name)
+        return base_query.get_item(models.TlsProfile, fields=request.args.get('fields'), name=name)
 
     def put(self, name):
         data = request.json
         del data['name']
-        return base_query.update_item(models.TlsProfile, {'name': name}, **data)        
+        rsp = base_query.update_item(models.TlsProfile, {'name': name}, **data)
+        return rsp
 
     def delete(self, name):
         base_query.delete_item(models.TlsProfile, name=name)
 
 
+@api.route('/performance-profiles')
+class PerformanceProfileList(Resource):
+    @cached(models.PerformanceProfile)
+    def get(self):
+        return base_query.get_all_items(models.PerformanceProfile, **request.args)
+
+    def post(self):
+        base_query.create_item(models.PerformanceProfile, **request.json)
+
+
+@api.route('/performance-profile/<string:name>')
+class PerformanceProfile(Resource):
+    def get(self, name):
+        return base_query.get_item(models.PerformanceProfile, fields=request.args.get('fields'), name=name)
+
+    def put(self, name):
+        data = request.json
+        del data['name']
+        rsp = base_query.update_item(models.PerformanceProfile, {'name': name}, **data)
+        fanout.changed(models.PerformanceProfile, [name])
+        return rsp
+
+    def delete(self, name):
+        base_query.delete_item(models.PerformanceProfile, name=name)
+        fanout.changed(models.PerformanceProfile, [name])
+
+
 @api.route('/certificates')
 class CertificateList(Resource):
+    @cached(models.Certificate)
     def get(self):
-        # rearrange date
-        data = base_query.get_all_items(models.Certificate, **request.args)
-        for item in data['items']:
-            # can't send body and key
-            del item['body']
-            del item['private_key']
-            item['expiry_date'] = item['expiry_date'].get('$date', "")
-            item['issue_date'] = item['issue_date'].get('$date', "")
-        return data
+        # body and key are not sent (Certificate.exclude_fields)
+        return base_query.get_all_items(models.Certificate, **request.args)
 
     def post(self):
         # parse certificate for important information
@@ -154,12 +233,15 @@ class CertificateList(Resource):
                 dns.extend(ext._subjectAltNameString().split(","))
         base_query.create_item(models.Certificate, exclude_search=["body", "private_key"],
             issue_date=issue_date, expiry_date=expiry_date, subjects=dns, **request.json)
+        # tls profiles may refer to the certificate name already
 
 
 @api.route('/certificate/<string:name>')
 class Certificate(Resource):
     def get(self, name):
-        return base_query.get_item(models.Certificate, name=name)
+        # the full certificate is sent here
+        return base_query.get_item(models.Certificate, exclude=[],
+            fields=request.args.get('fields'), name=name)
 
     def delete(self, name):
         base_query.delete_item(models.Certificate, name=name)
@@ -167,54 +249,99 @@ class Certificate(Resource):
 
 @api.route('/addresses')
 class AddressList(Resource):
+    @cached(models.Address)
     def get(self):
         return base_query.get_all_items(models.Address, **request.args)
 
     def post(self):
         base_query.create_item(models.Address, **request.json)
+        fanout.changed(models.Address, [request.json.get('name')])
+
+
+@api.route('/addresses/bulk')
+class AddressBulk(Resource):
+    def post(self):
+        """
+        Create or update (by name) the list of addresses
+        """
+        rsp = base_query.bulk_upsert(models.Address, request.json, ['name'])
+        fanout.changed(models.Address, [item.get('name') for item in request.json])
+        return rsp
+
+
+@api.route('/addresses/lookup')
+class AddressLookup(Resource):
+    def get(self):
+        """
+        Addresses containing ip=<ip> or overlapping overlaps=<cidr>, and
+        the policy rules that match it: the rules using these addresses,
+        the rules with a literal ip/cidr source matching it and the rules
+        with the any source
+        """
+        ip = request.args.get('ip')
+        cidr = request.args.get('overlaps')
+        try:
+            if ip is not None:
+                query = ip_ranges.contains_query(ip)
+            elif cidr is not None:
+                query = ip_ranges.overlaps_query(cidr)
+            else:
+                abort(400)
+        except ValueError as e:
+            abort(400, str(e))
+        addresses = [base_query.to_dict(doc) for doc in base_query.project(
+            models.Address, models.Address.objects(__raw__=query))]
+        names = [address['name'] for address in addresses]
+        rules = [base_query.to_dict(doc) for doc in base_query.project(
+            models.PolicyProfileRule, models.PolicyProfileRule.objects(source__in=names + ['any']))]
+        # the literal sources are not indexed by range, checked here
+        literal = models.PolicyProfileRule.objects(
+            source__regex=ip_ranges.LITERAL_SOURCE, source__nin=names)
+        rules.extend(base_query.to_dict(doc) for doc in base_query.project(
+            models.PolicyProfileRule, literal)
+            if ip_ranges.literal_matches(doc.get('source', ''), ip=ip, cidr=cidr))
+        return {'addresses': addresses, 'policy_rules': rules}
 
 
 @api.route('/address/<string:name>')
 class Address(Resource):
     def get(self, name):
-        return base_query.get_item(models.Address, name=name)
+        return base_query.get_item(models.Address, fields=request.args.get('fields'), name=name)
 
     def put(self, name):
         data = request.json
         del data['name']
-        return base_query.update_item(models.Address, {'name': name}, **data)        
+        rsp = base_query.update_item(models.Address, {'name': name}, **data)
+        fanout.changed(models.Address, [name])
+        return rsp
 
     def delete(self, name):
         base_query.delete_item(models.Address, name=name)
+        fanout.changed(models.Address, [name])
 
 
 @api.route('/kube-profiles')
 class KubeProfileList(Resource):
+    @cached(models.KubeProfile)
     def get(self):
         data = base_query.get_all_items(models.KubeProfile, **request.args)
-        # delete kube_config
+        # kube_config is not read from the db, show it as hidden
         for item in data['items']:
             item['kube_config'] = 'CONTENTS-HIDDEN'
         return data
 
     def post(self):
         # get the clusters in the kube_config
-        kube_config = request.json['kube_config']
-        tmp_fd, tmp_file_name = tempfile.mkstemp(text=True)
-        fd = os.fdopen(tmp_fd, "w")
-        fd.write(kube_config)
-        fd.close()
-        kubernetes.config.load_kube_config(tmp_file_name)
-        _, cur_context = kubernetes.config.list_kube_config_contexts()
+        kube_config = yaml.safe_load(request.json['kube_config'])
         base_query.create_item(models.KubeProfile,
-            cluster=cur_context['name'], exclude_search=["kube_config"],
+            cluster=kube_config['current-context'], exclude_search=["kube_config"],
             **request.json)
 
 
 @api.route('/kube-profile/<string:name>')
 class KubeProfile(Resource):
     def get(self, name):
-        item = base_query.get_item(models.KubeProfile, name=name)
+        item = base_query.get_item(models.KubeProfile, fields=request.args.get('fields'), name=name)
         # dont send kube config
         item['kube_config'] = "CONTENTS-HIDDEN"
         return item
@@ -225,15 +352,22 @@ class KubeProfile(Resource):
             # dont update kube_config
             del data['kube_config']
         del data['name']
-        return base_query.update_item(models.KubeProfile, {'name': name},
-            exclude_search=["kube_config"], **data)        
+        # written by the watcher only
+        data.pop('watch_resource_version', None)
+        data.pop('watch_stats', None)
+        rsp = base_query.update_item(models.KubeProfile, {'name': name},
+            exclude_search=["kube_config"], **data)
+        kube_clients.invalidate(name)
+        return rsp
 
     def delete(self, name):
         base_query.delete_item(models.KubeProfile, name=name)
+        kube_clients.invalidate(name)
 
 
 @api.route('/policy-profiles')
 class PolicyProfileList(Resource):
+    @cached(models.PolicyProfile)
     def get(self):
         """
         Get rules for the given service name
@@ -248,14 +382,17 @@ class PolicyProfileList(Resource):
 @api.route('/policy-profile/<string:name>')
 class PolicyProfile(Resource):
     def get(self, name):
-        return base_query.get_item(models.PolicyProfile, name=name)
+        return base_query.get_item(models.PolicyProfile, fields=request.args.get('fields'), name=name)
 
     def delete(self, name):
-        return base_query.delete_item(models.PolicyProfile, name=name)
+        rsp = base_query.delete_item(models.PolicyProfile, name=name)
+        fanout.changed(models.PolicyProfile, [name])
+        return rsp
 
 
 @api.route('/policy-rules/<string:policy_profile_name>')
 class PolicyProfileRuleList(Resource):
+    @cached(models.PolicyProfileRule)
     def get(self, policy_profile_name):
         return base_query.get_all_items(models.PolicyProfileRule,
             profile_name=policy_profile_name, **request.args)
@@ -263,28 +400,132 @@ class PolicyProfileRuleList(Resource):
     def post(self, policy_profile_name):
         body = request.json
         body['profile_name'] = policy_profile_name
+        # rule_count of the profile is updated by create_item
         base_query.create_item(models.PolicyProfileRule, **body)
-        # get number of rules in the profile
-        items = base_query.get_all_items(models.PolicyProfileRule, profile_name=policy_profile_name)
-        base_query.update_item(models.PolicyProfile, {'name': policy_profile_name}, rule_count=items['count'])
+        fanout.changed(models.PolicyProfile, [policy_profile_name])
+
+
+@api.route('/policy-rules/<string:policy_profile_name>/bulk')
+class PolicyProfileRuleBulk(Resource):
+    def post(self, policy_profile_name):
+        """
+        Add the list of rules to the profile
+        """
+        items = request.json
+        base_query.check_items(items)
+        for item in items:
+            item['profile_name'] = policy_profile_name
+        rsp = base_query.bulk_create(models.PolicyProfileRule, items)
+        fanout.changed(models.PolicyProfile, [policy_profile_name])
+        return rsp
 
 
 @api.route('/policy-rule/<string:policy_profile_name>/<string:rule_id>')
 class PolicyProfileRule(Resource):
     def get(self, policy_profile_name, rule_id):
         return base_query.get_item(models.PolicyProfileRule,
+            fields=request.args.get('fields'),
             profile_name=policy_profile_name, id=rule_id)
 
     def put(self, policy_profile_name, rule_id):
         body = request.json
         del body['id']
-        return base_query.update_item(models.PolicyProfileRule,
+        rsp = base_query.update_item(models.PolicyProfileRule,
             {'profile_name': policy_profile_name, 'id': rule_id},
             body)
+        fanout.changed(models.PolicyProfile, [policy_profile_name])
+        return rsp
 
     def delete(self, policy_profile_name, rule_id):
-        return base_query.delete_item(models.PolicyProfileRule,
+        rsp = base_query.delete_item(models.PolicyProfileRule,
             profile_name=policy_profile_name, id=rule_id)
+        fanout.changed(models.PolicyProfile, [policy_profile_name])
+        return rsp
+
+
+@api.route('/rollouts')
+class RolloutList(Resource):
+    @cached(models.Rollout)
+    def get(self):
+        """
+        Re-renders of the proxies after the profile changes (fanout)
+        """
+        return base_query.get_all_items(models.Rollout, **request.args)
+
+
+@api.route('/rollout/<string:rollout_id>')
+class Rollout(Resource):
+    def get(self, rollout_id):
+        return base_query.get_item(models.Rollout, fields=request.args.get('fields'), id=rollout_id)
+
+
+@api.route('/jobs')
+class JobList(Resource):
+    @cached(models.Job)
+    def get(self):
+        return base_query.get_all_items(models.Job, **request.args)
+
+
+@api.route('/jobs/<string:job_id>')
+class Job(Resource):
+    def get(self, job_id):
+        """
+        Status and timings (wait_ms, duration_ms) of the job
+        """
+        return base_query.get_item(models.Job, fields=request.args.get('fields'), id=job_id)
+
+
+# collection name in /export/<collection> to model
+EXPORT_MODELS = {
+    'services': models.Service,
+    'waf-rule-sets': models.WafRuleSet,
+    'waf-profiles': models.WafProfile,
+    'waf-profile-rule-sets': models.WafProfileRuleSet,
+    'tls-profiles': models.TlsProfile,
+    'performance-profiles': models.PerformanceProfile,
+    'certificates': models.Certificate,
+    'addresses': models.Address,
+    'kube-profiles': models.KubeProfile,
+    'policy-profiles': models.PolicyProfile,
+    'policy-rules': models.PolicyProfileRule,
+    'rollouts': models.Rollout,
+    'jobs': models.Job,
+}
+
+
+def export_json(docs):
+    # chunked json array
+    yield '['
+    sep = ''
+    for doc in docs:
+        yield sep + json.dumps(doc)
+        sep = ','
+    yield ']'
+
+
+@api.route('/export/<string:collection>')
+class Export(Resource):
+    def get(self, collection):
+        """
+        Stream all the documents of the collection as ndjson (default) or
+        as a json array with format=json. Takes the same filters as the list,
+        the paging arguments are ignored
+        """
+        model_cls = EXPORT_MODELS.get(collection)
+        if model_cls is None:
+            abort(404)
+        args = request.args.to_dict()
+        fmt = args.pop('format', 'ndjson')
+        # the query is checked here, the response is streamed once the
+        # status is sent
+        try:
+            docs = base_query.iter_items(model_cls, **args)
+        except ValueError as e:
+            abort(400, str(e))
+        if fmt == 'json':
+            return Response(export_json(docs), mimetype='application/json')
+        return Response((json.dumps(doc) + '\n' for doc in docs),
+                        mimetype='application/x-ndjson')
 
 
 if __name__ == "__main__":
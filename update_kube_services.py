@@ -2,22 +2,57 @@
 Add/Update kubernetes services
 """
 
+import asyncio
+import collections
 import datetime
+import hashlib
+import json
+import logging
 from multiprocessing import Process
 import os
-import tempfile
+import threading
+import time
 
-from mongoengine import connect, errors, disconnect
-from kubernetes import config, client, watch
+from mongoengine import Q, connect, errors, disconnect
+from kubernetes import client, watch
+from pymongo import UpdateOne
 
+import base_query
 import create_proxy_svc
+import kube_clients
 import models
+import reconciler
 
 
 MONGODB = "mongodb://localhost/sbf"
+# number of services processed concurrently per kube profile
+WORKERS = int(os.getenv('SBF_RECONCILE_WORKERS', 4))
+# max services waiting to be processed (queued or debounced) before the
+# watch stream is paused
+QUEUE_SIZE = int(os.getenv('SBF_RECONCILE_QUEUE_SIZE', 100))
+MAX_RETRIES = int(os.getenv('SBF_RECONCILE_MAX_RETRIES', 5))
+# seconds to collapse the ADDED/MODIFIED events of a service into one
+DEBOUNCE = float(os.getenv('SBF_DEBOUNCE_SECONDS', 2))
+# seconds between the saves of the watch stats on the kube profile
+STATS_INTERVAL = 60
+WATCH_EVENTS = ('ADDED', 'MODIFIED', 'DELETED')
+# seconds between the saves of the processed resourceVersion
+SAVE_INTERVAL = float(os.getenv('SBF_WATCH_SAVE_INTERVAL', 10))
+# the watch is restarted (from the last event) after this many seconds
+WATCH_TIMEOUT = int(os.getenv('SBF_WATCH_TIMEOUT', 300))
+# process: a process per kube profile read at start, asyncio: one process
+# supervising the watches of the profiles as they are added or removed
+CONTROLLER_MODE = os.getenv('SBF_CONTROLLER_MODE', 'process')
+# seconds between the checks of the kube profiles in the asyncio mode
+PROFILE_POLL_INTERVAL = float(os.getenv('SBF_PROFILE_POLL_INTERVAL', 10))
+# reconnect backoff after a watch or list error
+RECONNECT_BACKOFF = 1.0
+MAX_RECONNECT_BACKOFF = 60.0
 
+log = logging.getLogger(__name__)
 
-def upsert_service(kube_profile_name, svc, modified=False):
+
+def service_data(kube_profile_name, svc):
     # svc is the data obtained from the list_service or watch event
     # that has metadata and spec dicts
     labels = []
@@ -38,62 +73,525 @@ def upsert_service(kube_profile_name, svc, modified=False):
         "uid": svc.metadata.uid,
         "cluster_ip": svc.spec.cluster_ip,
         "ports": list(map(lambda x: {'name': x.name, 'port': x.port},
-                          svc.spec.ports)),
+                          svc.spec.ports or [])),
+        "resource_version": svc.metadata.resource_version,
     }
-    db_svc = models.Service.objects(uid=svc.metadata.uid)
-    if db_svc.count() < 1:
-        # new doc
-        data['date_added'] = datetime.datetime.now()
-        data['date_modified'] = datetime.datetime.now()
+    data['spec_hash'] = spec_hash(data)
+    data['search_tokens'] = base_query.search_tokens(models.Service, data)
+    return data
+
+
+def spec_hash(data):
+    """
+    Hash of the values the proxy is rendered from, a change of the other
+    values (eg. annotations, status) does not need proxy work
+    """
+    spec = [data['name'], data['namespace'], data['cluster_ip'], data['ports'], data['labels']]
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def upsert_service(kube_profile_name, svc, modified=False):
+    data = service_data(kube_profile_name, svc)
+    now = datetime.datetime.now()
+    data['deleted'] = False
+    data['set_on_insert__date_added'] = now
     if modified:
-        data['date_modified'] = datetime.datetime.now()
+        data['date_modified'] = now
+    else:
+        data['set_on_insert__date_modified'] = now
+    # the previous doc, None if it is new
+    prev = models.Service.objects(uid=svc.metadata.uid).only(
+        'spec_hash', 'deleted', 'proxy_pending').modify(upsert=True, new=False, **data)
+    base_query.bump_version(models.Service)
+    if (prev is not None and prev.spec_hash == data['spec_hash'] and not prev.deleted
+            and not prev.proxy_pending):
+        # nothing the proxy is rendered from changed and the last render
+        # did not fail
+        return
+    protect_synced(svc.metadata.uid)
+
 
-    rsp = models.Service.objects(uid=svc.metadata.uid).modify(
-        upsert=True, new=True, **data)
-    create_proxy_svc.protect_service(rsp)
+def protect_synced(uid, resync=False):
+    # the doc is up to date with the kube service, only the proxy is updated.
+    # The svc stays proxy_pending until the proxy is rendered, so that the
+    # next event or relist renders it again if this fails (the spec hash
+    # matches by then)
+    app_svc = models.Service.objects(uid=uid, deleted__ne=True).modify(
+        new=True, set__proxy_pending=True)
+    if app_svc is None:
+        return
+    base_query.bump_version(models.Service)
+    # saved by protect_service once the proxy is rendered
+    app_svc.proxy_pending = False
+    create_proxy_svc.protect_service(app_svc, resync=resync)
 
 
 def delete_service(event_object):
-    app_svc = models.Service.objects(uid=event_object.metadata.uid).get()
+    app_svc = models.Service.objects(uid=event_object.metadata.uid).first()
+    if app_svc is None:
+        # added and deleted in the same debounce window
+        return
     create_proxy_svc.delete_protection(app_svc)
     models.Service.objects(uid=event_object.metadata.uid).delete()
+    base_query.bump_version(models.Service)
 
 
-def process_event(event_type, event_object, kube_profile_name):
+def is_ignored(event_object):
     if event_object.metadata.namespace == "kube-system" or event_object.metadata.name == "kubernetes":
-        return
+        return True
     # if event has labels "type=sbf-proxy"
-    ltype = event_object.metadata.labels.get('type', "")
-    if ltype == "sbf-proxy":
+    ltype = (event_object.metadata.labels or {}).get('type', "")
+    return ltype == "sbf-proxy"
+
+
+def process_event(event_type, event_object, kube_profile_name):
+    if is_ignored(event_object):
         return
     if event_type == "ADDED":
         upsert_service(kube_profile_name, event_object)
     elif event_type == "MODIFIED":
         upsert_service(kube_profile_name, event_object, modified=True)
+    elif event_type in ("SYNCED", "ENDPOINTS"):
+        # written by reconcile_services or the endpoints of a svc in the
+        # endpoints mode changed (watch_endpoints)
+        protect_synced(event_object.metadata.uid)
+    elif event_type == "RESYNC":
+        # all the proxy objects are applied (submit_resyncs)
+        protect_synced(event_object.metadata.uid, resync=True)
     elif event_type == "DELETED":
         delete_service(event_object)
 
 
+def reconcile_services(kube_profile_name, items):
+    """
+    Diff the listed kube services against the Service docs of the profile
+    by uid, resourceVersion and spec hash, write the inserts, updates and
+    soft-deletes in one bulk_write. Return the (event type, object) of the
+    services that need proxy work
+    """
+    docs = {}
+    for doc in models.Service.objects(kube_profile=kube_profile_name).only(
+            'uid', 'name', 'namespace', 'resource_version', 'spec_hash', 'deleted',
+            'proxy_pending').as_pymongo():
+        docs[doc.get('uid')] = doc
+    now = datetime.datetime.now()
+    ops = []
+    changed = []
+    listed = set()
+    for svc in items:
+        if is_ignored(svc):
+            continue
+        uid = svc.metadata.uid
+        listed.add(uid)
+        doc = docs.get(uid)
+        # a svc whose proxy failed to render is rendered again
+        synced = doc and not doc.get('deleted') and not doc.get('proxy_pending')
+        if synced and doc.get('resource_version') == svc.metadata.resource_version:
+            continue
+        data = service_data(kube_profile_name, svc)
+        if synced and doc.get('spec_hash') == data['spec_hash']:
+            # metadata only change, no proxy work
+            ops.append(UpdateOne({'uid': uid}, {'$set': {
+                'resource_version': data['resource_version']}}))
+            continue
+        data['date_modified'] = now
+        data['deleted'] = False
+        data['proxy_pending'] = True
+        ops.append(UpdateOne({'uid': uid}, {'$set': data, '$setOnInsert': {'date_added': now}},
+                             upsert=True))
+        changed.append(('SYNCED', svc))
+    for uid, doc in docs.items():
+        if uid in listed:
+            continue
+        # deleted while the watch was not running, the doc is removed
+        # after the proxy is
+        if not doc.get('deleted'):
+            ops.append(UpdateOne({'uid': uid}, {'$set': {'deleted': True, 'date_modified': now}}))
+        svc = client.V1Service(metadata=client.V1ObjectMeta(
+            uid=uid, name=doc.get('name'), namespace=doc.get('namespace'), labels={}))
+        changed.append(('DELETED', svc))
+    if ops:
+        models.Service._get_collection().bulk_write(ops, ordered=False)
+        base_query.bump_version(models.Service)
+    return changed
+
+
+class WatchProgress:
+    """
+    resourceVersion up to which the watch events are processed, the watch
+    is resumed from it after a restart. Events are numbered as they are
+    submitted, an event is done when the reconciler ran it or a later
+    event of the same service (coalesced)
+    """
+    def __init__(self, resource_version=None):
+        self.lock = threading.Lock()
+        self.seq = 0
+        # service events submitted and handler runs for them
+        self.events = 0
+        self.processed = 0
+        # uid -> (seq, resource version) of its latest event
+        self.latest = {}
+        # (seq, resource version) in submit order
+        self.versions = collections.deque()
+        self.resource_version = resource_version
+
+    def submitted(self, uid, resource_version, resumable=True):
+        # uid is None for the versions that are not a service event
+        # (bookmarks, lists). The watch is not resumed from the version of
+        # an event that is not resumable: the items of a list are not in
+        # resource version order, only the version of the whole list is
+        # resumed from once all its items are done
+        with self.lock:
+            self.seq += 1
+            if uid is not None:
+                self.events += 1
+                self.latest[uid] = (self.seq, resource_version)
+            if resumable:
+                self.versions.append((self.seq, resource_version))
+
+    def done(self, uid, resource_version):
+        with self.lock:
+            self.processed += 1
+            if uid in self.latest and self.latest[uid][1] == resource_version:
+                del self.latest[uid]
+
+    def processed_version(self):
+        with self.lock:
+            oldest = min(seq for seq, _ in self.latest.values()) if self.latest else self.seq + 1
+            while self.versions and self.versions[0][0] < oldest:
+                _, self.resource_version = self.versions.popleft()
+            return self.resource_version
+
+    def stats(self):
+        """
+        Service events submitted, processed and coalesced (run as part of
+        a later event of the service), the coalescing ratio is the events
+        per processed one
+        """
+        with self.lock:
+            return {
+                'events': self.events,
+                'processed': self.processed,
+                'coalesced': max(0, self.events - self.processed - len(self.latest)),
+                'coalescing_ratio': round(self.events / max(1, self.processed), 2),
+            }
+
+
+def save_resource_version(kube_profile_name, resource_version):
+    models.KubeProfile.objects(name=kube_profile_name).update_one(
+        set__watch_resource_version=resource_version)
+    base_query.bump_version(models.KubeProfile)
+
+
+def save_watch_stats(kube_profile_name, stats):
+    models.KubeProfile.objects(name=kube_profile_name).update_one(
+        set__watch_stats=dict(stats, date=datetime.datetime.utcnow()))
+    base_query.bump_version(models.KubeProfile)
+
+
+def relist(v1, workers, progress, kube_profile_name):
+    """
+    Reconcile the docs with all the services of the cluster and submit
+    the services that changed. Return the resourceVersion of the list
+    """
+    rsp = v1.list_service_for_all_namespaces()
+    changed = reconcile_services(kube_profile_name, rsp.items)
+    log.info("%s: %d services listed, %d changed", kube_profile_name, len(rsp.items), len(changed))
+    for event_type, svc in changed:
+        progress.submitted(svc.metadata.uid, svc.metadata.resource_version, resumable=False)
+        workers.submit(svc.metadata.uid, event_type, svc, kube_profile_name)
+    progress.submitted(None, rsp.metadata.resource_version)
+    return rsp.metadata.resource_version
+
+
+def submit_resyncs(kube_profile_name, workers):
+    """
+    Submit the services of the profile whose proxy objects were not all
+    applied for RESYNC_INTERVAL, the objects edited or deleted out of band
+    are restored
+    """
+    limit = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=create_proxy_svc.RESYNC_INTERVAL)
+    for doc in models.Service.objects(
+            Q(proxy_date_applied__lt=limit) | Q(proxy_date_applied=None),
+            kube_profile=kube_profile_name, deleted__ne=True).only(
+            'uid', 'name', 'namespace').as_pymongo():
+        svc = client.V1Service(metadata=client.V1ObjectMeta(
+            uid=doc['uid'], name=doc.get('name'), namespace=doc.get('namespace'), labels={}))
+        # keyed apart from the svc events, see submit_endpoints
+        workers.submit(('resync', doc['uid']), "RESYNC", svc, kube_profile_name)
+
+
+def event_error(event):
+    """
+    Status code of an ERROR event, older clients return the 410 Gone of
+    the watch as an event instead of raising it
+    """
+    obj = event.get('raw_object', event['object'])
+    if isinstance(obj, dict):
+        return obj.get('code', 500)
+    return 500
+
+
+def watch_services(kube_profile_name, resource_version, workers, progress, stop=None):
+    """
+    Watch the services of the cluster and submit the events to workers
+    until stop (threading.Event) is set. The watch is resumed from
+    resource_version, relisted if there is none or it is gone and
+    reconnected with backoff on errors
+    """
+    saved_version = resource_version
+    backoff = RECONNECT_BACKOFF
+    stats_time = save_time = time.time()
+    while stop is None or not stop.is_set():
+        try:
+            v1 = kube_clients.core_api(kube_profile_name)
+            if not resource_version:
+                log.info("%s: listing the services", kube_profile_name)
+                resource_version = relist(v1, workers, progress, kube_profile_name)
+            watcher = watch.Watch()
+            for event in watcher.stream(v1.list_service_for_all_namespaces,
+                                        resource_version=resource_version,
+                                        allow_watch_bookmarks=True,
+                                        timeout_seconds=WATCH_TIMEOUT):
+                if stop is not None and stop.is_set():
+                    watcher.stop()
+                    break
+                if event['type'] == 'ERROR':
+                    raise client.rest.ApiException(status=event_error(event), reason="watch error")
+                obj = event['object']
+                resource_version = obj.metadata.resource_version
+                backoff = RECONNECT_BACKOFF
+                if event['type'] == 'BOOKMARK':
+                    progress.submitted(None, resource_version)
+                elif event['type'] in WATCH_EVENTS:
+                    progress.submitted(obj.metadata.uid, resource_version)
+                    # DELETED is not delayed and cancels the pending add/modify
+                    delay = 0 if event['type'] == 'DELETED' else DEBOUNCE
+                    workers.submit(obj.metadata.uid, event['type'], obj,
+                                   kube_profile_name, delay=delay)
+                if time.time() - save_time > SAVE_INTERVAL:
+                    save_time = time.time()
+                    processed = progress.processed_version()
+                    if processed and processed != saved_version:
+                        save_resource_version(kube_profile_name, processed)
+                        saved_version = processed
+                if time.time() - stats_time > STATS_INTERVAL:
+                    stats_time = time.time()
+                    stats = progress.stats()
+                    log.info("%s: events %d processed %d coalesced %d coalescing ratio %.2f",
+                             kube_profile_name, stats['events'], stats['processed'],
+                             stats['coalesced'], stats['coalescing_ratio'])
+                    save_watch_stats(kube_profile_name, stats)
+            # watch timed out, resumed from the last event
+            if stop is None or not stop.is_set():
+                submit_resyncs(kube_profile_name, workers)
+        except Exception as e:
+            if isinstance(e, client.rest.ApiException) and e.status == 410:
+                # the version is too old (compacted), list again
+                log.info("%s: watch version %s is gone, relisting", kube_profile_name,
+                         resource_version)
+                resource_version = None
+                continue
+            log.warning("%s: watch failed: %s, reconnecting in %.0fs",
+                        kube_profile_name, e, backoff)
+            if stop is not None:
+                stop.wait(backoff)
+            else:
+                time.sleep(backoff)
+            backoff = min(MAX_RECONNECT_BACKOFF, backoff * 2)
+    log.info("%s: watch stopped", kube_profile_name)
+
+
+def endpoints_services(kube_profile_name):
+    """
+    {(namespace, name): uid} of the services of the profile proxied to
+    their pod endpoints
+    """
+    return {(doc['namespace'], doc['name']): doc['uid'] for doc in models.Service.objects(
+        kube_profile=kube_profile_name, proxy_upstream_mode='endpoints', deleted__ne=True,
+        proxy_lb_method__ne='ip_hash').only('namespace', 'name', 'uid').as_pymongo()}
+
+
+def submit_endpoints(workers, kube_profile_name, uid, key, resource_version):
+    # keyed apart from the svc events so that they are not coalesced with
+    # (and do not drop) an add/modify of the svc
+    obj = client.V1Endpoints(metadata=client.V1ObjectMeta(
+        uid=uid, namespace=key[0], name=key[1], resource_version=resource_version))
+    workers.submit(('endpoints', uid), "ENDPOINTS", obj, kube_profile_name, delay=DEBOUNCE)
+
+
+def watch_endpoints(kube_profile_name, workers, stop=None):
+    """
+    Watch the endpoints of the cluster and render the proxies of the
+    services in the endpoints mode again when their pods change, until
+    stop is set. The changes missed while the watch was not running are
+    not known, the proxies are rendered when the watch is (re)started
+    """
+    resource_version = None
+    services = {}
+    services_version = None
+    backoff = RECONNECT_BACKOFF
+    while stop is None or not stop.is_set():
+        try:
+            v1 = kube_clients.core_api(kube_profile_name)
+            if not resource_version:
+                resource_version = v1.list_endpoints_for_all_namespaces(
+                    limit=1).metadata.resource_version
+                services_version = base_query.get_version(models.Service)
+                services = endpoints_services(kube_profile_name)
+                for key, uid in services.items():
+                    submit_endpoints(workers, kube_profile_name, uid, key, resource_version)
+            watcher = watch.Watch()
+            for event in watcher.stream(v1.list_endpoints_for_all_namespaces,
+                                        resource_version=resource_version,
+                                        timeout_seconds=WATCH_TIMEOUT):
+                if stop is not None and stop.is_set():
+                    watcher.stop()
+                    break
+                if event['type'] == 'ERROR':
+                    raise client.rest.ApiException(status=event_error(event), reason="watch error")
+                obj = event['object']
+                resource_version = obj.metadata.resource_version
+                backoff = RECONNECT_BACKOFF
+                version = base_query.get_version(models.Service)
+                if version != services_version:
+                    # a svc was added or its upstream mode changed
+                    services_version = version
+                    services = endpoints_services(kube_profile_name)
+                key = (obj.metadata.namespace, obj.metadata.name)
+                if key in services:
+                    submit_endpoints(workers, kube_profile_name, services[key], key,
+                                     resource_version)
+        except Exception as e:
+            if isinstance(e, client.rest.ApiException) and e.status == 410:
+                resource_version = None
+                continue
+            log.warning("%s: endpoints watch failed: %s, reconnecting in %.0fs",
+                        kube_profile_name, e, backoff)
+            if stop is not None:
+                stop.wait(backoff)
+            else:
+                time.sleep(backoff)
+            backoff = min(MAX_RECONNECT_BACKOFF, backoff * 2)
+    log.info("%s: endpoints watch stopped", kube_profile_name)
+
+
+def new_workers(progress_of):
+    # events are processed in a worker pool, serialized per service uid.
+    # progress_of(kube profile name) is the WatchProgress of the event
+    def on_done(uid, args):
+        progress = progress_of(args[2])
+        # the endpoints and resync work is not a watch event
+        if progress is not None and args[0] in WATCH_EVENTS:
+            progress.done(uid, args[1].metadata.resource_version)
+    return reconciler.Reconciler(process_event, workers=WORKERS,
+        queue_size=QUEUE_SIZE, retry_exceptions=(client.rest.ApiException,),
+        max_retries=MAX_RETRIES, on_done=on_done)
+
+
 def monitor_kube(kube_profile):
     connect(host=MONGODB)
+    progress = WatchProgress(kube_profile.watch_resource_version)
+    workers = new_workers(lambda name: progress)
+    threading.Thread(target=watch_endpoints, args=(kube_profile.name, workers),
+                     daemon=True).start()
+    # resume from the last processed version, relist if there is none
+    watch_services(kube_profile.name, kube_profile.watch_resource_version, workers, progress)
+
+
+def load_profiles():
+    return {profile['name']: profile for profile in models.KubeProfile.objects.only(
+        'name', 'date_modified', 'watch_resource_version').as_pymongo()}
 
-    tmp_fd, tmp_file_name = tempfile.mkstemp(text=True)
-    fd = os.fdopen(tmp_fd, "w")
-    fd.write(kube_profile.kube_config)
-    fd.close()
-    config.load_kube_config(tmp_file_name)
-    v1 = client.CoreV1Api()
-    # do a first consolidation of all the services
-    rsp = v1.list_service_for_all_namespaces()
-    resource_version = rsp.metadata.resource_version
-    for svc in rsp.items:
-        process_event('ADDED', svc, kube_profile.name)
-    watcher = watch.Watch()
-    for event in watcher.stream(v1.list_service_for_all_namespaces, resource_version=resource_version):
-        process_event(event['type'], event['object'], kube_profile.name)
+
+def start_thread(loop, func, *args):
+    """
+    Run the blocking func in its own thread, return a future of the loop
+    that is done when it returns
+    """
+    future = loop.create_future()
+
+    def run():
+        try:
+            func(*args)
+        except Exception:
+            log.exception("%s failed", func.__name__)
+        finally:
+            loop.call_soon_threadsafe(future.set_result, None)
+    threading.Thread(target=run, name="watch-%s" % args[0], daemon=True).start()
+    return future
+
+
+async def run_controller():
+    """
+    One event loop supervising the service watches of all the kube
+    profiles. The streams are started and stopped as the KubeProfile
+    documents are added, modified (kube_config) or deleted, the events of
+    all the clusters are processed by one bounded worker pool
+    """
+    loop = asyncio.get_running_loop()
+    # kube profile name -> {'stop', 'future', 'progress', 'date_modified'}
+    streams = {}
+
+    def progress_of(name):
+        stream = streams.get(name)
+        return stream['progress'] if stream else None
+    workers = new_workers(progress_of)
+    # kube profile name -> future of the stream being stopped, the stream
+    # ends on its next event or watch timeout
+    stopping = {}
+    version = None
+    while True:
+        # the profiles are read only when the collection changed
+        current = await loop.run_in_executor(None, base_query.get_version, models.KubeProfile)
+        if current != version:
+            version = current
+            profiles = await loop.run_in_executor(None, load_profiles)
+            for name, stream in list(streams.items()):
+                profile = profiles.get(name)
+                if profile is None or profile.get('date_modified') != stream['date_modified']:
+                    log.info("%s: stopping the watch", name)
+                    stream['stop'].set()
+                    stopping[name] = stream['future']
+                    del streams[name]
+            for name, profile in profiles.items():
+                if name in streams:
+                    continue
+                if name in stopping and not stopping[name].done():
+                    # started when the previous stream is done
+                    version = None
+                    continue
+                stopping.pop(name, None)
+                log.info("%s: starting the watch", name)
+                progress = WatchProgress(profile.get('watch_resource_version'))
+                stop = threading.Event()
+                streams[name] = {
+                    'stop': stop,
+                    'progress': progress,
+                    'date_modified': profile.get('date_modified'),
+                    'future': start_thread(loop, watch_services, name,
+                                           profile.get('watch_resource_version'),
+                                           workers, progress, stop),
+                }
+                start_thread(loop, watch_endpoints, name, workers, stop)
+        for name in [name for name, future in stopping.items() if future.done()]:
+            if name not in profiles:
+                del stopping[name]
+        for name, stream in list(streams.items()):
+            if stream['future'].done():
+                # not expected, restarted on the next pass
+                del streams[name]
+                version = None
+        await asyncio.sleep(PROFILE_POLL_INTERVAL)
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
+    if CONTROLLER_MODE == 'asyncio':
+        connect(host=MONGODB)
+        asyncio.run(run_controller())
+        return
     process_ids = []
     connect(host=MONGODB)
     kube_profiles = list(models.KubeProfile.objects)
